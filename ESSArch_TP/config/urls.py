@@ -40,6 +40,7 @@ from ESSArch_Core.stats.views import stats, export as export_stats
 from configuration.views import EventTypeViewSet
 from ip.views import InformationPackageViewSet
 from profiles.views import ProfileViewSet, ProfileSAViewSet, SubmissionAgreementViewSet
+from workflow.views import WorkflowPollView
 
 admin.site.site_header = 'ESSArch Tools Producer Administration'
 admin.site.site_title = 'ESSArch Tools Producer Administration'
@@ -102,6 +103,7 @@ urlpatterns = [
     url(r'^api/stats/export/$', export_stats),
     url(r'^api/sysinfo/', SysInfoView.as_view()),
     url(r'^api/me/$', MeView.as_view(), name='me'),
+    url(r'^api/workflow-poll/$', WorkflowPollView.as_view(), name='workflow-poll'),
     url(r'^api/', include(router.urls)),
     url(r'^accounts/changepassword', auth_views.PasswordChangeView.as_view(), {'post_change_redirect': '/'}),
     url(r'^api-auth/', include('rest_framework.urls', namespace='rest_framework')),
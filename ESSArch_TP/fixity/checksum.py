@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import logging
+import os
+import sys
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import cache
+
+from ESSArch_Core.fixity import checksum as core_checksum
+
+logger = logging.getLogger('essarch.etp.fixity.checksum')
+
+# Checksums are keyed on the identity of the file contents rather than on the
+# path, so they survive renames, hard links and moves within a filesystem
+CHECKSUM_CACHE_KEY = 'etp_checksum:{algorithm}:{st.st_dev}:{st.st_ino}:{st.st_size}:{st.st_mtime_ns}'
+CHECKSUM_STATS_CACHE_KEY = 'etp_checksum_stats:{}'
+
+# Seconds that a recorded checksum is kept, unless set in CHECKSUM_CACHE_TIMEOUT
+DEFAULT_CHECKSUM_CACHE_TIMEOUT = 30 * 24 * 60 * 60
+
+_core_calculate_checksum = core_checksum.calculate_checksum
+
+# The recorded_checksums() blocks of each thread and the lookups within them,
+# added to the shared counters when the outermost block exits
+_local = threading.local()
+
+
+def normalize_algorithm(algorithm):
+    return algorithm.upper().replace('-', '')
+
+
+def get_hasher(algorithm):
+    return hashlib.new(normalize_algorithm(algorithm).lower())
+
+
+def update_hashers(path, hashers, size=None, block_size=65536):
+    """
+    Updates ``hashers`` with the first ``size`` bytes (or all) of ``path``
+    """
+
+    remaining = os.path.getsize(path) if size is None else size
+    with open(path, 'rb') as f:
+        while remaining > 0:
+            buf = f.read(min(block_size, remaining))
+            if not buf:
+                break
+            for hasher in hashers:
+                hasher.update(buf)
+            remaining -= len(buf)
+
+
+def _get_cache_key(st, algorithm):
+    return CHECKSUM_CACHE_KEY.format(algorithm=normalize_algorithm(algorithm), st=st)
+
+
+def _get_cache_timeout():
+    return getattr(settings, 'CHECKSUM_CACHE_TIMEOUT', DEFAULT_CHECKSUM_CACHE_TIMEOUT)
+
+
+def cache_checksum(path, algorithm, checksum):
+    """
+    Records the checksum of ``path``, it is valid for as long as the file
+    has the same device, inode, size and modification time
+    """
+
+    cache.set(_get_cache_key(os.stat(path), algorithm), checksum, timeout=_get_cache_timeout())
+
+
+def get_cached_checksum(path, algorithm):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+
+    checksum = cache.get(_get_cache_key(st, algorithm))
+    if getattr(_local, 'depth', 0):
+        _local.stats['hits' if checksum is not None else 'misses'] += 1
+    return checksum
+
+
+def _add_stats(hits, misses):
+    if not (hits or misses):
+        return
+
+    # incr is atomic in the cache, the counters are shared by all processes
+    for name, count in (('hits', hits), ('misses', misses)):
+        if count:
+            key = CHECKSUM_STATS_CACHE_KEY.format(name)
+            cache.add(key, 0)
+            cache.incr(key, count)
+
+    stats = get_checksum_stats()
+    logger.info('Found {} of {} checksums in the cache, {:.0%} of {} lookups so far'.format(
+        hits, hits + misses, stats['hit_rate'], stats['hits'] + stats['misses'],
+    ))
+
+
+def get_checksum_stats():
+    """
+    Returns the number of checksums found and not found in the cache by
+    tasks using ``recorded_checksums``, and the resulting hit rate
+    """
+
+    hits = cache.get(CHECKSUM_STATS_CACHE_KEY.format('hits'), 0)
+    misses = cache.get(CHECKSUM_STATS_CACHE_KEY.format('misses'), 0)
+    total = hits + misses
+    return {'hits': hits, 'misses': misses, 'hit_rate': hits / total if total else None}
+
+
+def calculate_checksum(filename, algorithm='SHA-256', block_size=65536):
+    checksum = get_cached_checksum(filename, algorithm)
+    if checksum is not None:
+        logger.debug('Using recorded %s checksum of %s' % (algorithm, filename))
+        return checksum
+
+    key = _get_cache_key(os.stat(filename), algorithm)
+    checksum = _core_calculate_checksum(filename, algorithm, block_size)
+
+    # only record the checksum if the file didn't change while it was read
+    if _get_cache_key(os.stat(filename), algorithm) == key:
+        cache.set(key, checksum, timeout=_get_cache_timeout())
+
+    return checksum
+
+
+def cache_tree_checksums(path, algorithms=None, block_size=65536):
+    """
+    Records the checksums in ``algorithms`` of every file below ``path``
+    that haven't already been recorded, reading each file at most once.
+
+    Args:
+        algorithms: Defaults to ``UPLOAD_CHECKSUM_ALGORITHMS``
+
+    Returns:
+        The number of files that were read
+    """
+
+    if algorithms is None:
+        algorithms = getattr(settings, 'UPLOAD_CHECKSUM_ALGORITHMS', ['SHA-256'])
+
+    read = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            filename = os.path.join(root, name)
+            missing = [a for a in algorithms if get_cached_checksum(filename, a) is None]
+            if not missing:
+                continue
+
+            st = os.stat(filename)
+            keys = [_get_cache_key(st, algorithm) for algorithm in missing]
+            hashers = [get_hasher(algorithm) for algorithm in missing]
+            update_hashers(filename, hashers, size=st.st_size, block_size=block_size)
+            read += 1
+
+            # only record the checksums if the file didn't change while it was read
+            if _get_cache_key(os.stat(filename), missing[0]) == keys[0]:
+                cache.set_many(
+                    {key: hasher.hexdigest() for key, hasher in zip(keys, hashers)},
+                    timeout=_get_cache_timeout(),
+                )
+
+    logger.debug('Read {} files to record their checksums in {}'.format(read, path))
+    return read
+
+
+def _dispatch_calculate_checksum(filename, algorithm='SHA-256', block_size=65536):
+    """
+    Installed in place of the ``calculate_checksum`` imported by ESSArch Core
+    modules. Only threads within a ``recorded_checksums()`` block use
+    recorded checksums, all others get the behaviour of Core
+    """
+
+    if getattr(_local, 'depth', 0):
+        return calculate_checksum(filename, algorithm, block_size)
+    return _core_calculate_checksum(filename, algorithm, block_size)
+
+
+def _install_dispatch():
+    for module in list(sys.modules.values()):
+        if module is None or not getattr(module, '__name__', '').startswith('ESSArch_Core'):
+            continue
+        if getattr(module, 'calculate_checksum', None) is _core_calculate_checksum:
+            module.calculate_checksum = _dispatch_calculate_checksum
+
+
+@contextmanager
+def recorded_checksums():
+    """
+    Makes ESSArch Core use checksums recorded with ``cache_checksum`` instead
+    of reading the files again, e.g. when generating or validating METS files.
+
+    Only calls made by the current thread are affected, so other tasks
+    running in the same process keep reading their files.
+    """
+
+    _install_dispatch()
+
+    outermost = not getattr(_local, 'depth', 0)
+    if outermost:
+        _local.stats = {'hits': 0, 'misses': 0}
+
+    _local.depth = getattr(_local, 'depth', 0) + 1
+    try:
+        yield
+    finally:
+        _local.depth -= 1
+        if outermost:
+            _add_stats(_local.stats['hits'], _local.stats['misses'])
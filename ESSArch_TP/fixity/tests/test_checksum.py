@@ -0,0 +1,138 @@
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import types
+from unittest import mock
+
+from django.core.cache import cache
+from django.test import SimpleTestCase, override_settings
+
+from fixity import checksum
+from fixity.checksum import (
+    cache_checksum, cache_tree_checksums, calculate_checksum, get_cached_checksum, get_checksum_stats,
+    recorded_checksums,
+)
+
+
+class ChecksumCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.datadir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.datadir)
+
+        self.path = os.path.join(self.datadir, 'foo.txt')
+        with open(self.path, 'wb') as f:
+            f.write(b'foo')
+        self.sha256 = hashlib.sha256(b'foo').hexdigest()
+
+    def test_cache_checksum(self):
+        cache_checksum(self.path, 'SHA-256', self.sha256)
+
+        self.assertEqual(get_cached_checksum(self.path, 'SHA-256'), self.sha256)
+        self.assertEqual(get_cached_checksum(self.path, 'sha256'), self.sha256)
+        self.assertIsNone(get_cached_checksum(self.path, 'MD5'))
+
+    def test_checksum_follows_file_when_renamed_or_linked(self):
+        cache_checksum(self.path, 'SHA-256', self.sha256)
+
+        link = os.path.join(self.datadir, 'link.txt')
+        os.link(self.path, link)
+        self.assertEqual(get_cached_checksum(link, 'SHA-256'), self.sha256)
+
+        renamed = os.path.join(self.datadir, 'renamed.txt')
+        os.rename(self.path, renamed)
+        self.assertEqual(get_cached_checksum(renamed, 'SHA-256'), self.sha256)
+
+    def test_modified_file(self):
+        cache_checksum(self.path, 'SHA-256', self.sha256)
+
+        with open(self.path, 'ab') as f:
+            f.write(b'bar')
+        self.assertIsNone(get_cached_checksum(self.path, 'SHA-256'))
+
+    @override_settings(CHECKSUM_CACHE_TIMEOUT=60)
+    def test_checksums_expire(self):
+        with mock.patch('fixity.checksum.cache') as mock_cache:
+            mock_cache.get.return_value = None
+            cache_checksum(self.path, 'SHA-256', self.sha256)
+            calculate_checksum(self.path, 'MD5')
+            cache_tree_checksums(self.datadir, algorithms=['SHA-1'])
+
+        for call in mock_cache.set.call_args_list + mock_cache.set_many.call_args_list:
+            self.assertEqual(call[1]['timeout'], 60)
+        self.assertEqual(mock_cache.set.call_count, 2)
+        mock_cache.set_many.assert_called_once()
+
+    def test_calculate_checksum_records_checksum(self):
+        with mock.patch('fixity.checksum._core_calculate_checksum', return_value=self.sha256) as mock_calc:
+            self.assertEqual(calculate_checksum(self.path), self.sha256)
+            self.assertEqual(calculate_checksum(self.path), self.sha256)
+
+        mock_calc.assert_called_once_with(self.path, 'SHA-256', 65536)
+
+    @override_settings(UPLOAD_CHECKSUM_ALGORITHMS=['SHA-256', 'MD5'])
+    def test_cache_tree_checksums(self):
+        os.makedirs(os.path.join(self.datadir, 'sub'))
+        other = os.path.join(self.datadir, 'sub', 'bar.txt')
+        with open(other, 'wb') as f:
+            f.write(b'bar')
+        cache_checksum(self.path, 'SHA-256', self.sha256)
+
+        with mock.patch('fixity.checksum.update_hashers', wraps=checksum.update_hashers) as mock_update:
+            self.assertEqual(cache_tree_checksums(self.datadir), 2)
+
+        # each file is read once, only for the checksums it's missing
+        self.assertEqual(mock_update.call_count, 2)
+        self.assertEqual(get_cached_checksum(self.path, 'MD5'), hashlib.md5(b'foo').hexdigest())
+        self.assertEqual(get_cached_checksum(other, 'SHA-256'), hashlib.sha256(b'bar').hexdigest())
+        self.assertEqual(get_cached_checksum(other, 'MD5'), hashlib.md5(b'bar').hexdigest())
+
+        self.assertEqual(cache_tree_checksums(self.datadir), 0)
+
+    def test_stats(self):
+        for name in ['hits', 'misses']:
+            cache.delete(checksum.CHECKSUM_STATS_CACHE_KEY.format(name))
+        cache_checksum(self.path, 'SHA-256', self.sha256)
+
+        with self.assertLogs('essarch.etp.fixity.checksum', level='INFO') as logs:
+            with recorded_checksums():
+                get_cached_checksum(self.path, 'SHA-256')
+                with recorded_checksums():
+                    get_cached_checksum(self.path, 'SHA-256')
+                get_cached_checksum(self.path, 'MD5')
+
+                # lookups outside of the block aren't counted
+                other = threading.Thread(target=get_cached_checksum, args=(self.path, 'SHA-256'))
+                other.start()
+                other.join()
+        get_cached_checksum(self.path, 'SHA-256')
+
+        self.assertEqual(get_checksum_stats(), {'hits': 2, 'misses': 1, 'hit_rate': 2 / 3})
+        self.assertEqual(len(logs.records), 1)
+        self.assertIn('Found 2 of 3 checksums in the cache', logs.output[0])
+
+    def test_recorded_checksums_only_in_current_thread(self):
+        cache_checksum(self.path, 'SHA-256', 'recorded')
+        core_module = types.ModuleType('ESSArch_Core.fake')
+        self.addCleanup(sys.modules.pop, core_module.__name__, None)
+        sys.modules[core_module.__name__] = core_module
+
+        def calculate_in_thread():
+            results['other'] = core_module.calculate_checksum(self.path)
+
+        results = {}
+        with mock.patch('fixity.checksum._core_calculate_checksum', return_value=self.sha256) as mock_calc:
+            core_module.calculate_checksum = mock_calc
+
+            with recorded_checksums():
+                results['inside'] = core_module.calculate_checksum(self.path)
+
+                other = threading.Thread(target=calculate_in_thread)
+                other.start()
+                other.join()
+
+            results['outside'] = core_module.calculate_checksum(self.path)
+
+        self.assertEqual(results, {'inside': 'recorded', 'other': self.sha256, 'outside': self.sha256})
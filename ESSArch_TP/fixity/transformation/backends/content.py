@@ -1,21 +1,35 @@
 # -*- coding: utf-8 -*-
 
+import logging
 import os
-import shutil
+
+from django.utils.functional import cached_property
 
 from ESSArch_Core.fixity.transformation.backends.base import BaseTransformer
 from ESSArch_Core.util import find_destination
+from storage.copy import move_into
+
+logger = logging.getLogger('essarch.etp.fixity.transformation.ContentTransformer')
 
 
 class ContentTransformer(BaseTransformer):
-    def transform(self, path):
-        # move all dirs and files (except those specified in IP profile) to content
+    @cached_property
+    def structure(self):
+        return self.ip.get_structure()
 
-        structure = self.ip.get_structure()
-        content_dir, content_name = find_destination('content', structure)
-        content_path = os.path.join(self.ip.object_path, content_dir, content_name)
+    @cached_property
+    def content_path(self):
+        content_dir, content_name = find_destination('content', self.structure)
+        return os.path.join(self.ip.object_path, content_dir, content_name)
+
+    @cached_property
+    def reserved(self):
+        return {x['use'] for x in self.structure if 'use' in x}
+
+    def transform(self, path, progress_callback=None):
+        # move all dirs and files (except those specified in IP profile) to content
 
-        reserved = [x['use'] for x in structure if 'use' in x]
-        for f in os.listdir(path):
-            if f not in reserved:
-                shutil.move(os.path.join(path, f), content_path)
+        srcs = [os.path.join(path, f) for f in os.listdir(path) if f not in self.reserved]
+        copied = move_into(srcs, self.content_path, progress_callback=progress_callback)
+        logger.info(u'Moved {} entries to {}, {} bytes copied'.format(len(srcs), self.content_path, copied))
+        return copied
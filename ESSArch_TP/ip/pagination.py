@@ -0,0 +1,86 @@
+"""
+    ESSArch is an open source archiving and digital preservation system
+
+    ESSArch Tools for Producer (ETP)
+    Copyright (C) 2005-2017 ES Solutions AB
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+    Contact information:
+    Web - http://www.essolutions.se
+    Email - essarch@essolutions.se
+"""
+
+from rest_framework import exceptions, filters, pagination
+from rest_framework.response import Response
+
+
+class CursorPagination(pagination.CursorPagination):
+    """
+    Keyset pagination, selected with ``?pager=cursor``. Unlike the offset
+    based default every page costs the same, however deep it is.
+
+    The results are ordered like ``OrderingFilter`` orders them if the
+    request has an ``?ordering=``, and otherwise on ``cursor_ordering`` of
+    the view or the ordering listed for the model below. The links to the
+    next and previous pages are returned in the ``Link`` header like in
+    ``LinkHeaderPagination``.
+    """
+
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+    ordering = ('-pk',)
+
+    orderings = {
+        'ip.InformationPackage': ('-create_date', '-pk'),
+        'ip.EventIP': ('-eventDateTime', '-pk'),
+    }
+
+    def get_requested_ordering(self, request, queryset, view):
+        for backend in getattr(view, 'filter_backends', []):
+            if not issubclass(backend, filters.OrderingFilter):
+                continue
+            if not request.query_params.get(backend.ordering_param):
+                return None
+
+            ordering = backend().get_ordering(request, queryset, view)
+            if not ordering:
+                return None
+            if any('__' in field for field in ordering):
+                raise exceptions.ParseError('Ordering on related fields is not supported with pager=cursor')
+
+            # the cursor needs a unique ordering
+            ordering = list(ordering)
+            if not any(field.lstrip('-') in ('pk', 'id') for field in ordering):
+                ordering.append('-pk')
+            return ordering
+
+        return None
+
+    def get_ordering(self, request, queryset, view):
+        ordering = self.get_requested_ordering(request, queryset, view)
+        if ordering is None:
+            ordering = getattr(view, 'cursor_ordering', None)
+        if ordering is None:
+            ordering = self.orderings.get(queryset.model._meta.label, self.ordering)
+        return tuple(ordering)
+
+    def get_paginated_response(self, data):
+        links = []
+        for url, rel in ((self.get_next_link(), 'next'), (self.get_previous_link(), 'prev')):
+            if url is not None:
+                links.append('<{}>; rel="{}"'.format(url, rel))
+
+        headers = {'Link': ', '.join(links)} if links else {}
+        return Response(data, headers=headers)
@@ -22,37 +22,87 @@
     Email - essarch@essolutions.se
 """
 
+from django.utils.functional import cached_property
 from rest_framework import serializers
 
 from ESSArch_Core.ip.serializers import InformationPackageSerializer as CoreInformationPackageSerializer
 from ESSArch_Core.profiles.serializers import ProfileIPSerializer
 from ESSArch_Core.profiles.utils import profile_types
 
+p_types = [p_type.lower().replace(' ', '_') for p_type in profile_types]
+
+
+def get_query_param_set(request, param):
+    if request is None:
+        return None
+
+    value = request.query_params.get(param)
+    if value is None:
+        return None
+
+    return {name.strip() for name in value.split(',') if name.strip()}
+
 
 class InformationPackageSerializer(CoreInformationPackageSerializer):
     profiles = serializers.SerializerMethodField()
 
+    def get_profile_relations(self, obj):
+        # use the relations prefetched with to_attr='profiles' when listing
+        profiles = getattr(obj, 'profiles', None)
+        if profiles is None:
+            profiles = obj.profileip_set.select_related('profile', 'LockedBy')
+        return profiles
+
     def get_profiles(self, obj):
-        profiles = getattr(obj, 'profiles', obj.profileip_set)
-        return ProfileIPSerializer(profiles, many=True, context=self.context).data
+        return ProfileIPSerializer(self.get_profile_relations(obj), many=True, context=self.context).data
 
     class Meta(CoreInformationPackageSerializer.Meta):
         fields = CoreInformationPackageSerializer.Meta.fields + ('profiles',)
 
 
 class InformationPackageReadSerializer(InformationPackageSerializer):
-    def to_representation(self, obj):
-        data = super().to_representation(obj)
-        profiles = data['profiles']
-        data['profiles'] = {}
+    """
+    Represents each profile relation as a ``profile_<type>`` field.
 
-        for ptype in profile_types:
-            data['profile_%s' % ptype] = None
+    The fields can be limited using the comma separated ``fields`` and
+    ``omit`` query parameters, e.g. ``?fields=id,label,profile_sip``.
+    """
 
-        for p in profiles:
-            data['profile_%s' % p['profile_type']] = p
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
 
-        data.pop('profiles', None)
+        request = self.context.get('request')
+        requested = get_query_param_set(request, 'fields')
+        omitted = get_query_param_set(request, 'omit') or set()
+
+        def include(name):
+            return (requested is None or name in requested) and name not in omitted
+
+        # profiles are added in to_representation
+        self.fields.pop('profiles')
+        for name in list(self.fields):
+            if not include(name):
+                self.fields.pop(name)
+
+        self.include_profile = include
+        self.profile_fields = [name for name in ('profile_%s' % p_type for p_type in p_types) if include(name)]
+        self.include_profiles = requested is None or any(name.startswith('profile_') for name in requested)
+
+    @cached_property
+    def profile_serializer(self):
+        # a single instance serializes the profiles of every IP
+        return ProfileIPSerializer(context=self.context)
+
+    def to_representation(self, obj):
+        data = super().to_representation(obj)
+        if not self.include_profiles:
+            return data
+
+        data.update(dict.fromkeys(self.profile_fields))
+        for profile_ip in self.get_profile_relations(obj):
+            name = 'profile_%s' % profile_ip.profile.profile_type
+            if self.include_profile(name):
+                data[name] = self.profile_serializer.to_representation(profile_ip)
 
         return data
 
@@ -26,12 +26,15 @@ from unittest import mock
 
 import filecmp
 import glob
+import hashlib
 import os
 import shutil
 
 from django.contrib.auth.models import User, Permission
 from django.core.files.uploadedfile import SimpleUploadedFile
-from django.test import TestCase
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 
 from rest_framework import status
@@ -44,6 +47,8 @@ from ESSArch_Core.ip.models import InformationPackage
 from ESSArch_Core.profiles.models import Profile, ProfileIP, SubmissionAgreement
 from ESSArch_Core.WorkflowEngine.models import ProcessTask
 
+from fixity.checksum import get_cached_checksum
+
 
 class CreateIPTestCase(TestCase):
     def setUp(self):
@@ -178,6 +183,164 @@ class CreateIPTestCase(TestCase):
         self.assertEqual(InformationPackage.objects.filter(label='label').count(), 2)
 
 
+class ListIPTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create(username="admin")
+        self.client.force_authenticate(user=self.user)
+        self.url = reverse('informationpackage-list')
+
+        self.org_group_type = GroupType.objects.create(label='organization')
+        self.org = Group.objects.create(name='organization', group_type=self.org_group_type)
+
+        perms = Permission.objects.filter(codename='view_informationpackage')
+        self.user_role = GroupMemberRole.objects.create(codename='user_role')
+        self.user_role.permissions.set(perms)
+
+        membership = GroupMember.objects.create(member=self.user.essauth_member, group=self.org)
+        membership.roles.add(self.user_role)
+
+    def create_ips(self, count):
+        for _ in range(count):
+            ip = InformationPackage.objects.create(responsible=self.user)
+            self.org.add_object(ip)
+
+            for profile_type in ['transfer_project', 'submit_description']:
+                profile = Profile.objects.create(profile_type=profile_type)
+                ProfileIP.objects.create(ip=ip, profile=profile, LockedBy=self.user)
+
+    def list_ips(self, **params):
+        params.setdefault('pager', 'none')
+        with CaptureQueriesContext(connection) as queries:
+            res = self.client.get(self.url, params)
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        return res.data, len(queries)
+
+    def test_profiles(self):
+        self.create_ips(1)
+        data, _ = self.list_ips()
+
+        self.assertEqual(len(data), 1)
+        self.assertEqual(data[0]['profile_transfer_project']['profile_type'], 'transfer_project')
+        self.assertEqual(data[0]['profile_submit_description']['profile_type'], 'submit_description')
+        self.assertNotIn('profiles', data[0])
+
+    def test_sparse_fields(self):
+        self.create_ips(1)
+        data, _ = self.list_ips(fields='id,label,profile_transfer_project')
+
+        self.assertEqual(set(data[0].keys()), {'id', 'label', 'profile_transfer_project'})
+        self.assertEqual(data[0]['profile_transfer_project']['profile_type'], 'transfer_project')
+
+    def test_sparse_fields_without_profiles(self):
+        self.create_ips(1)
+        data, _ = self.list_ips(fields='id')
+
+        self.assertEqual(set(data[0].keys()), {'id'})
+
+    def test_omit_fields(self):
+        self.create_ips(1)
+        data, _ = self.list_ips(omit='label,profile_submit_description')
+
+        self.assertNotIn('label', data[0])
+        self.assertNotIn('profile_submit_description', data[0])
+        self.assertIn('id', data[0])
+        self.assertIn('profile_transfer_project', data[0])
+
+    def test_cursor_pagination(self):
+        self.create_ips(3)
+        ips = InformationPackage.objects.order_by('-create_date', '-pk')
+        newest_first = [str(pk) for pk in ips.values_list('pk', flat=True)]
+
+        res = self.client.get(self.url, {'pager': 'cursor', 'page_size': 2})
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual([ip['id'] for ip in res.data], newest_first[:2])
+        self.assertIn('rel="next"', res['Link'])
+
+        next_url = res['Link'].split(';')[0].strip('<>')
+        res = self.client.get(next_url)
+        self.assertEqual([ip['id'] for ip in res.data], newest_first[2:])
+        self.assertNotIn('rel="next"', res['Link'])
+
+    def test_cursor_pagination_with_ordering(self):
+        self.create_ips(3)
+        for label, ip in zip(['b', 'c', 'a'], InformationPackage.objects.all()):
+            ip.label = label
+            ip.save()
+
+        res = self.client.get(self.url, {'pager': 'cursor', 'page_size': 2, 'ordering': 'label'})
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual([ip['label'] for ip in res.data], ['a', 'b'])
+
+        next_url = res['Link'].split(';')[0].strip('<>')
+        res = self.client.get(next_url)
+        self.assertEqual([ip['label'] for ip in res.data], ['c'])
+
+    def test_query_count_independent_of_number_of_ips(self):
+        self.create_ips(1)
+        data, queries_for_one = self.list_ips()
+        self.assertEqual(len(data), 1)
+
+        self.create_ips(9)
+        data, queries_for_ten = self.list_ips()
+        self.assertEqual(len(data), 10)
+
+        self.assertEqual(queries_for_one, queries_for_ten)
+
+
+class PrepareIPTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username="admin", is_superuser=True)
+
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+        self.sa = SubmissionAgreement.objects.create()
+        self.ip = InformationPackage.objects.create(
+            state='Preparing', submission_agreement=self.sa, submission_agreement_locked=True,
+        )
+        self.url = reverse('informationpackage-prepare', args=(self.ip.pk,))
+
+        for profile_type in ['sip', 'transfer_project', 'submit_description']:
+            profile = Profile.objects.create(profile_type=profile_type)
+            setattr(self.sa, 'profile_%s' % profile_type, profile)
+            ProfileIP.objects.create(ip=self.ip, profile=profile)
+        self.sa.save()
+
+    def test_prepare_in_background(self):
+        res = self.client.post(self.url)
+
+        self.assertEqual(res.status_code, status.HTTP_202_ACCEPTED)
+        self.assertTrue(ProcessTask.objects.filter(
+            processstep__pk=res.data['step'],
+            name='preingest.tasks.CreatePhysicalModel',
+        ).exists())
+
+        self.ip.refresh_from_db()
+        self.assertEqual(self.ip.state, 'Preparing')
+        self.assertFalse(ProfileIP.objects.filter(ip=self.ip, LockedBy__isnull=True).exists())
+
+    def test_missing_profiles(self):
+        ProfileIP.objects.filter(profile__profile_type__in=['sip', 'transfer_project']).delete()
+
+        res = self.client.post(self.url)
+
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(res.data['detail'], [
+            'Information package missing SIP profile',
+            'Information package missing Transfer Project profile',
+        ])
+        self.assertFalse(ProfileIP.objects.filter(ip=self.ip, LockedBy__isnull=False).exists())
+        self.assertFalse(ProcessTask.objects.filter(information_package=self.ip).exists())
+
+    def test_prepare_twice(self):
+        self.client.post(self.url)
+
+        res = self.client.post(self.url)
+        self.assertEqual(res.status_code, status.HTTP_409_CONFLICT)
+
+
 class test_delete_ip(TestCase):
     def setUp(self):
         self.user = User.objects.create(username="admin")
@@ -450,6 +613,20 @@ class UploadTestCase(TestCase):
             res = self.client.post(self.baseurl + 'upload/', data, format='multipart')
             self.assertEqual(res.status_code, status.HTTP_403_FORBIDDEN)
 
+    def test_upload_with_invalid_chunk_number(self):
+        perms = {'group': ['view_informationpackage', 'ip.can_upload']}
+        self.member.assign_object(self.group, self.ip, custom_permissions=perms)
+        InformationPackage.objects.filter(pk=self.ip.pk).update(responsible=self.user)
+
+        for params in [{}, {'flowChunkNumber': 'foo'}, {'flowChunkNumber': -1}]:
+            params['flowRelativePath'] = 'foo.txt'
+            res = self.client.get(self.baseurl + 'upload/', params)
+            self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+            params['file'] = SimpleUploadedFile('foo.txt', b'foo', content_type='multipart/form-data')
+            res = self.client.post(self.baseurl + 'upload/', params, format='multipart')
+            self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_upload_file_with_square_brackets_in_name(self):
         perms = {'group': ['view_informationpackage', 'ip.can_upload']}
         self.member.assign_object(self.group, self.ip, custom_permissions=perms)
@@ -474,6 +651,161 @@ class UploadTestCase(TestCase):
             self.client.post(self.baseurl + 'merge-uploaded-chunks/', data)
             self.assertTrue(filecmp.cmp(srcfile, dstfile, False))
 
+    def test_upload_file_with_flow_chunks_in_order(self):
+        perms = {'group': ['view_informationpackage', 'ip.can_upload']}
+        self.member.assign_object(self.group, self.ip, custom_permissions=perms)
+        InformationPackage.objects.filter(pk=self.ip.pk).update(responsible=self.user)
+
+        srcfile = os.path.join(self.src, 'foo.txt')
+        dstfile = os.path.join(self.dst, 'foo.txt')
+
+        with open(srcfile, 'w') as fp:
+            fp.write('bar')
+
+        with open(srcfile, 'rb') as fp:
+            for i in range(1, 4):
+                chunk = SimpleUploadedFile(srcfile, fp.read(1), content_type='multipart/form-data')
+                data = {
+                    'flowChunkNumber': i,
+                    'flowTotalChunks': 3,
+                    'flowRelativePath': os.path.basename(srcfile),
+                    'file': chunk,
+                }
+                res = self.client.post(self.baseurl + 'upload/', data, format='multipart')
+                self.assertEqual(res.status_code, status.HTTP_200_OK)
+
+                # chunks are folded into the file as they arrive
+                self.assertEqual(glob.glob('%s_*' % dstfile), [])
+
+        res = self.client.get(self.baseurl + 'upload/', {'flowChunkNumber': 2, 'flowRelativePath': 'foo.txt'})
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+
+        data = {'path': dstfile}
+        res = self.client.post(self.baseurl + 'merge-uploaded-chunks/', data)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertTrue(filecmp.cmp(srcfile, dstfile, False))
+        self.assertEqual(os.listdir(self.dst), ['foo.txt'])
+
+    def test_upload_session(self):
+        perms = {'group': ['view_informationpackage', 'ip.can_upload']}
+        self.member.assign_object(self.group, self.ip, custom_permissions=perms)
+        InformationPackage.objects.filter(pk=self.ip.pk).update(responsible=self.user)
+
+        with mock.patch('ESSArch_Core.ip.models.InformationPackage.save') as mock_save:
+            for i in range(3):
+                chunk = SimpleUploadedFile('foo.txt', b'ab', content_type='multipart/form-data')
+                data = {
+                    'flowChunkNumber': i,
+                    'flowRelativePath': 'foo.txt',
+                    'file': chunk,
+                }
+                res = self.client.post(self.baseurl + 'upload/', data, format='multipart')
+                self.assertEqual(res.status_code, status.HTTP_200_OK)
+
+            mock_save.assert_not_called()
+
+        self.ip.refresh_from_db()
+        self.assertEqual(self.ip.state, 'Uploading')
+
+        res = self.client.get(self.baseurl + 'upload-session/')
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res.data['bytes_received'], 6)
+        self.assertEqual(res.data['chunks_received'], 3)
+        self.assertIsNotNone(res.data['started'])
+
+    def test_uploaded_chunks(self):
+        perms = {'group': ['view_informationpackage', 'ip.can_upload']}
+        self.member.assign_object(self.group, self.ip, custom_permissions=perms)
+        InformationPackage.objects.filter(pk=self.ip.pk).update(responsible=self.user)
+
+        url = self.baseurl + 'uploaded-chunks/'
+        res = self.client.get(url, {'flowRelativePath': 'foo.txt'})
+        self.assertEqual(res.data, {'count': 0, 'chunks': []})
+
+        for i in [1, 2, 4]:
+            chunk = SimpleUploadedFile('foo.txt', b'a', content_type='multipart/form-data')
+            data = {
+                'flowChunkNumber': i,
+                'flowTotalChunks': 4,
+                'flowRelativePath': 'foo.txt',
+                'file': chunk,
+            }
+            self.client.post(self.baseurl + 'upload/', data, format='multipart')
+
+        res = self.client.get(url, {'flowRelativePath': 'foo.txt'})
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res.data, {'count': 3, 'chunks': [[1, 2], [4, 4]]})
+
+    def test_uploaded_chunks_without_path(self):
+        perms = {'group': ['view_informationpackage', 'ip.can_upload']}
+        self.member.assign_object(self.group, self.ip, custom_permissions=perms)
+        InformationPackage.objects.filter(pk=self.ip.pk).update(responsible=self.user)
+
+        res = self.client.get(self.baseurl + 'uploaded-chunks/')
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+    @override_settings(UPLOAD_CHECKSUM_ALGORITHMS=['SHA-256', 'MD5'])
+    def test_merge_records_checksums(self):
+        perms = {'group': ['view_informationpackage', 'ip.can_upload']}
+        self.member.assign_object(self.group, self.ip, custom_permissions=perms)
+        InformationPackage.objects.filter(pk=self.ip.pk).update(responsible=self.user)
+
+        dstfile = os.path.join(self.dst, 'foo.txt')
+
+        for i, content in enumerate([b'b', b'ar']):
+            chunk = SimpleUploadedFile('foo.txt', content, content_type='multipart/form-data')
+            data = {
+                'flowChunkNumber': i,
+                'flowRelativePath': 'foo.txt',
+                'file': chunk,
+            }
+            self.client.post(self.baseurl + 'upload/', data, format='multipart')
+
+        res = self.client.post(self.baseurl + 'merge-uploaded-chunks/', {'path': dstfile})
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+
+        self.assertEqual(get_cached_checksum(dstfile, 'SHA-256'), hashlib.sha256(b'bar').hexdigest())
+        self.assertEqual(get_cached_checksum(dstfile, 'MD5'), hashlib.md5(b'bar').hexdigest())
+
+    @mock.patch('ip.views.ProcessTask.run')
+    def test_merge_uploaded_chunks_in_background(self, mock_task):
+        perms = {'group': ['view_informationpackage', 'ip.can_upload']}
+        self.member.assign_object(self.group, self.ip, custom_permissions=perms)
+        InformationPackage.objects.filter(pk=self.ip.pk).update(responsible=self.user, state='Uploading')
+
+        dstfile = os.path.join(self.dst, 'foo.txt')
+        data = {'path': dstfile, 'background': True}
+        res = self.client.post(self.baseurl + 'merge-uploaded-chunks/', data)
+        self.assertEqual(res.status_code, status.HTTP_202_ACCEPTED)
+
+        task = ProcessTask.objects.get(pk=res.data['task'])
+        self.assertEqual(task.name, 'preingest.tasks.MergeUploadedChunks')
+        self.assertEqual(task.params, {'path': dstfile})
+        mock_task.assert_called_once()
+
+    @mock.patch('ip.views.ProcessTask.run')
+    @mock.patch('ip.views.ChunkedUpload.merge')
+    def test_merge_uploaded_chunks_background_false(self, mock_merge, mock_task):
+        perms = {'group': ['view_informationpackage', 'ip.can_upload']}
+        self.member.assign_object(self.group, self.ip, custom_permissions=perms)
+        InformationPackage.objects.filter(pk=self.ip.pk).update(responsible=self.user, state='Uploading')
+
+        data = {'path': os.path.join(self.dst, 'foo.txt'), 'background': 'false'}
+        res = self.client.post(self.baseurl + 'merge-uploaded-chunks/', data)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        mock_merge.assert_called_once_with()
+        mock_task.assert_not_called()
+
+    @mock.patch('ip.views.ChunkedUpload.merge', side_effect=TimeoutError)
+    def test_merge_uploaded_chunks_while_locked(self, mock_merge):
+        perms = {'group': ['view_informationpackage', 'ip.can_upload']}
+        self.member.assign_object(self.group, self.ip, custom_permissions=perms)
+        InformationPackage.objects.filter(pk=self.ip.pk).update(responsible=self.user, state='Uploading')
+
+        data = {'path': os.path.join(self.dst, 'foo.txt')}
+        res = self.client.post(self.baseurl + 'merge-uploaded-chunks/', data)
+        self.assertEqual(res.status_code, status.HTTP_409_CONFLICT)
+
 
 class test_change_sa(TestCase):
     def setUp(self):
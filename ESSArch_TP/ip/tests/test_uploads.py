@@ -0,0 +1,132 @@
+import hashlib
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+from django.test import SimpleTestCase, override_settings
+
+from fixity.checksum import get_cached_checksum
+from ip.uploads import ChunkedUpload, MissingChunkError
+
+
+@override_settings(UPLOAD_CHECKSUM_ALGORITHMS=['SHA-256'])
+class ChunkedUploadMergeTests(SimpleTestCase):
+    def setUp(self):
+        self.datadir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.datadir)
+
+        self.path = os.path.join(self.datadir, 'foo.txt')
+        self.upload = ChunkedUpload(self.path)
+
+    def write_chunk(self, number, content):
+        with open(self.upload.get_chunk_path(number), 'wb') as f:
+            f.write(content)
+
+    def test_merge(self):
+        self.write_chunk(0, b'foo')
+        self.write_chunk(1, b'bar')
+
+        self.assertEqual(self.upload.merge(), 6)
+
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(), b'foobar')
+        self.assertFalse(os.path.exists(self.upload.lock_path))
+
+    def test_merge_records_checksums(self):
+        self.write_chunk(0, b'foo')
+        self.write_chunk(1, b'bar')
+
+        self.upload.merge()
+
+        self.assertEqual(get_cached_checksum(self.path, 'SHA-256'), hashlib.sha256(b'foobar').hexdigest())
+
+    def test_merge_does_not_read_folded_chunks(self):
+        self.write_chunk(1, b'foo')
+        self.upload.fold()
+        self.write_chunk(2, b'bar')
+
+        with mock.patch('ip.uploads.get_hasher') as mock_hasher:
+            self.assertEqual(self.upload.merge(), 6)
+
+        mock_hasher.assert_not_called()
+        self.assertIsNone(get_cached_checksum(self.path, 'SHA-256'))
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(), b'foobar')
+
+    def test_fold_while_chunk_is_written(self):
+        def uploaded_file(*parts):
+            return mock.Mock(chunks=lambda: iter(parts))
+
+        def chunks():
+            yield b'b' * 10
+
+            # concurrent requests write and fold the chunks around it
+            self.upload.write_chunk(1, uploaded_file(b'a' * 20))
+            self.upload.fold()
+            self.upload.write_chunk(3, uploaded_file(b'c' * 20))
+            self.upload.fold()
+
+            yield b'b' * 10
+
+        self.upload.write_chunk(2, mock.Mock(chunks=chunks))
+        self.upload.fold()
+
+        self.assertEqual(self.upload.merge(), 60)
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(), b'a' * 20 + b'b' * 20 + b'c' * 20)
+        self.assertEqual(os.listdir(self.datadir), ['foo.txt'])
+
+    def test_merge_with_missing_chunk(self):
+        self.write_chunk(0, b'foo')
+        self.write_chunk(2, b'baz')
+
+        with self.assertRaises(MissingChunkError):
+            self.upload.merge()
+
+        self.assertFalse(os.path.exists(self.path))
+        self.assertTrue(os.path.isfile(self.upload.get_chunk_path(0)))
+        self.assertTrue(os.path.isfile(self.upload.get_chunk_path(2)))
+        self.assertFalse(os.path.exists(self.upload.lock_path))
+
+    def test_merge_with_missing_chunk_after_folded(self):
+        self.write_chunk(1, b'foo')
+        self.upload.fold()
+        self.write_chunk(3, b'baz')
+
+        with self.assertRaises(MissingChunkError):
+            self.upload.merge()
+
+        self.assertFalse(os.path.exists(self.path))
+
+    @mock.patch('ip.uploads.time.sleep')
+    def test_merge_waits_for_lock(self, mock_sleep):
+        self.write_chunk(0, b'foo')
+        self.upload.acquire_lock()
+
+        def release(seconds):
+            self.upload.release_lock()
+
+        mock_sleep.side_effect = release
+
+        self.assertEqual(self.upload.merge(), 3)
+        mock_sleep.assert_called_once()
+        self.assertFalse(os.path.exists(self.upload.lock_path))
+
+    def test_lock_of_dead_holder(self):
+        # a lock file left behind by a process that died isn't locked
+        open(self.upload.lock_path, 'w').close()
+        self.write_chunk(0, b'foo')
+
+        self.assertEqual(self.upload.merge(), 3)
+
+    @mock.patch('ip.uploads.time.sleep')
+    def test_wait_for_held_lock(self, mock_sleep):
+        self.upload.acquire_lock()
+        self.addCleanup(self.upload.release_lock)
+
+        with self.assertRaises(TimeoutError):
+            self.upload.wait_for_lock(timeout=0)
+
+        self.assertTrue(os.path.isfile(self.upload.lock_path))
+        self.assertFalse(os.path.exists(self.path))
@@ -0,0 +1,411 @@
+"""
+    ESSArch is an open source archiving and digital preservation system
+
+    ESSArch Tools for Producer (ETP)
+    Copyright (C) 2005-2017 ES Solutions AB
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+    Contact information:
+    Web - http://www.essolutions.se
+    Email - essarch@essolutions.se
+"""
+
+import errno
+import fcntl
+import json
+import logging
+import os
+import tempfile
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+from ESSArch_Core.exceptions import NoFileChunksFound
+
+from fixity.checksum import cache_checksum, get_hasher
+from storage.copy import append_file
+
+logger = logging.getLogger('essarch.etp.ip.uploads')
+
+# Flow.js numbers the chunks of a file starting from 1
+FIRST_CHUNK_NUMBER = 1
+
+# Seconds that merge waits for a concurrent fold to finish
+MERGE_LOCK_TIMEOUT = 10 * 60
+MERGE_LOCK_POLL_INTERVAL = 0.1
+
+
+class MissingChunkError(Exception):
+    pass
+
+
+def get_ranges(numbers):
+    """
+    Collapses a sorted iterable of integers into a list of inclusive
+    ``[first, last]`` ranges, e.g. ``[1, 2, 3, 5] -> [[1, 3], [5, 5]]``
+    """
+
+    ranges = []
+    for number in numbers:
+        if ranges and number == ranges[-1][1] + 1:
+            ranges[-1][1] = number
+        else:
+            ranges.append([number, number])
+    return ranges
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+class ChunkedUpload:
+    """
+    A file uploaded in chunks to an information package.
+
+    Each chunk is written to ``<path>_<n>``. Chunks that arrive in order are
+    folded into a hidden partial file as soon as they have been written, the
+    number of the next chunk to fold and the size of the partial file are
+    kept in a state file next to it. Merging the upload then only has to
+    append the chunks that arrived out of order before the partial file is
+    renamed to ``path``.
+
+    The number of each written chunk is also appended to a manifest so that
+    clients resuming an upload can get all chunks already uploaded with a
+    single request.
+
+    If no chunks were folded, the checksums of the merged file are calculated
+    while merging and recorded with ``fixity.checksum.cache_checksum`` so
+    that they don't have to be calculated again when creating the IP. The
+    partial file isn't read again to hash folded chunks, their checksums are
+    calculated when first needed instead.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.dirname, self.basename = os.path.split(path)
+        self.partial_path = self._get_sidecar_path('part')
+        self.state_path = self._get_sidecar_path('upload')
+        self.lock_path = self._get_sidecar_path('lock')
+        self.manifest_path = self._get_sidecar_path('chunks')
+        self._lock_fd = None
+
+    def _get_sidecar_path(self, suffix):
+        return os.path.join(self.dirname, '.%s.%s' % (self.basename, suffix))
+
+    def get_chunk_path(self, number):
+        return '%s_%s' % (self.path, number)
+
+    def list_chunks(self):
+        """
+        Returns a list of ``(number, path)`` tuples of all chunks on disk,
+        sorted by chunk number
+        """
+
+        prefix = self.basename + '_'
+        chunks = []
+
+        try:
+            entries = os.listdir(self.dirname)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return chunks
+
+        for entry in entries:
+            number = entry[len(prefix):]
+            if entry.startswith(prefix) and number.isdigit():
+                chunks.append((int(number), os.path.join(self.dirname, entry)))
+
+        return sorted(chunks)
+
+    def get_state(self):
+        try:
+            with open(self.state_path) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def set_state(self, state):
+        tmp = self.state_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp, self.state_path)
+
+    def is_folded(self, number):
+        state = self.get_state()
+        return 'next_chunk' in state and number < state['next_chunk']
+
+    def has_chunk(self, number):
+        return self.is_folded(number) or os.path.exists(self.get_chunk_path(number))
+
+    def write_chunk(self, number, chunk):
+        """
+        Writes ``chunk``, an uploaded file, as chunk number ``number``.
+        Chunks that already have been folded, e.g. when a client retries a
+        request, are ignored.
+
+        Returns:
+            True if the chunk was written, False if it was ignored
+        """
+
+        if self.is_folded(number):
+            return False
+
+        os.makedirs(self.dirname, exist_ok=True)
+
+        # write to a hidden temporary file and rename it when complete, so
+        # that fold never appends a chunk that is still being written
+        fd, tmp_path = tempfile.mkstemp(dir=self.dirname, prefix='.%s_%d.' % (self.basename, number), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as dst:
+                for c in chunk.chunks():
+                    dst.write(c)
+            os.replace(tmp_path, self.get_chunk_path(number))
+        except BaseException:
+            _remove(tmp_path)
+            raise
+
+        # a single small write in append mode, safe with concurrent requests
+        with open(self.manifest_path, 'a') as manifest:
+            manifest.write('%d\n' % number)
+
+        return True
+
+    def get_uploaded_chunks(self):
+        """
+        Returns the sorted numbers of all chunks that have been uploaded,
+        including those already folded into the partial file
+        """
+
+        state = self.get_state()
+        numbers = set(range(FIRST_CHUNK_NUMBER, state.get('next_chunk', FIRST_CHUNK_NUMBER)))
+
+        try:
+            with open(self.manifest_path) as manifest:
+                numbers.update(int(line) for line in manifest if line.strip().isdigit())
+        except (IOError, OSError):
+            pass
+
+        return sorted(numbers)
+
+    def acquire_lock(self):
+        """
+        Locks the upload using ``flock``, which the kernel releases if the
+        process holding it dies
+
+        Returns:
+            True if the lock was acquired, False if it is held by someone
+            else
+        """
+
+        while True:
+            fd = os.open(self.lock_path, os.O_CREAT | os.O_RDWR)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError as e:
+                os.close(fd)
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                return False
+
+            # the previous holder removes the file when releasing the lock,
+            # we might have locked a file that no longer is the lock file
+            try:
+                if os.path.samestat(os.fstat(fd), os.stat(self.lock_path)):
+                    self._lock_fd = fd
+                    return True
+            except FileNotFoundError:
+                pass
+            os.close(fd)
+
+    def release_lock(self):
+        _remove(self.lock_path)
+        os.close(self._lock_fd)
+        self._lock_fd = None
+
+    def wait_for_lock(self, timeout=MERGE_LOCK_TIMEOUT):
+        deadline = time.monotonic() + timeout
+        while not self.acquire_lock():
+            if time.monotonic() >= deadline:
+                raise TimeoutError(errno.ETIMEDOUT, 'Timed out waiting for lock', self.lock_path)
+            time.sleep(MERGE_LOCK_POLL_INTERVAL)
+
+    def _open_partial(self, state):
+        fd = os.open(self.partial_path, os.O_WRONLY | os.O_CREAT | getattr(os, 'O_BINARY', 0))
+        try:
+            # discard anything written after the last recorded chunk,
+            # e.g. by a worker that died while appending
+            size = state.get('size', 0)
+            os.ftruncate(fd, size)
+            os.lseek(fd, size, os.SEEK_SET)
+        except BaseException:
+            os.close(fd)
+            raise
+        return fd
+
+    def _append_chunk(self, fd, state, number, chunk_path, hashers=None):
+        state['size'] = state.get('size', 0) + append_file(chunk_path, fd, hashers=hashers)
+        state['next_chunk'] = number + 1
+        self.set_state(state)
+        _remove(chunk_path)
+
+    def fold(self):
+        """
+        Appends all chunks that are available in order to the partial file.
+        Does nothing if another request already is folding this upload.
+        """
+
+        if not self.acquire_lock():
+            return
+
+        try:
+            state = self.get_state()
+            number = state.get('next_chunk', FIRST_CHUNK_NUMBER)
+            chunk_path = self.get_chunk_path(number)
+            if not os.path.exists(chunk_path):
+                return
+
+            fd = self._open_partial(state)
+            try:
+                while os.path.exists(chunk_path):
+                    self._append_chunk(fd, state, number, chunk_path)
+                    number += 1
+                    chunk_path = self.get_chunk_path(number)
+            finally:
+                os.close(fd)
+        finally:
+            self.release_lock()
+
+    def merge(self, progress_callback=None, algorithms=None):
+        """
+        Appends all remaining chunks to the partial file and moves it to
+        ``path``. Expected to be called once all chunks have been uploaded.
+
+        Args:
+            progress_callback: Called with the number of merged bytes and the
+                total number of bytes after each chunk
+            algorithms: The checksum algorithms to record for the merged
+                file if no chunks were folded, defaults to
+                ``settings.UPLOAD_CHECKSUM_ALGORITHMS``
+
+        Returns:
+            The size of the merged file
+
+        Raises:
+            NoFileChunksFound: There is nothing to merge
+            MissingChunkError: A chunk between the first and the last is
+                missing
+        """
+
+        # a concurrent fold might still be appending to the partial file
+        self.wait_for_lock()
+        try:
+            return self._merge(progress_callback, algorithms)
+        finally:
+            self.release_lock()
+
+    def _merge(self, progress_callback, algorithms):
+        state = self.get_state()
+        chunks = self.list_chunks()
+        if not chunks and not state:
+            raise NoFileChunksFound
+
+        next_chunk = state.get('next_chunk', FIRST_CHUNK_NUMBER)
+        done = state.get('size', 0)
+        remaining = []
+        for number, chunk_path in chunks:
+            if state and number < next_chunk:
+                _remove(chunk_path)
+            else:
+                remaining.append((number, chunk_path))
+
+        expected = next_chunk if state else remaining[0][0]
+        for number, _ in remaining:
+            if number != expected:
+                raise MissingChunkError('Chunk {} of {} is missing'.format(expected, self.path))
+            expected += 1
+
+        total = done + sum(os.path.getsize(chunk_path) for _, chunk_path in remaining)
+
+        hashers = {}
+        if not done:
+            if algorithms is None:
+                algorithms = getattr(settings, 'UPLOAD_CHECKSUM_ALGORITHMS', [])
+            hashers = {algorithm: get_hasher(algorithm) for algorithm in algorithms}
+
+        fd = self._open_partial(state)
+        try:
+            for number, chunk_path in remaining:
+                self._append_chunk(fd, state, number, chunk_path, hashers=list(hashers.values()))
+                done = state['size']
+                if progress_callback is not None:
+                    progress_callback(done, total)
+        finally:
+            os.close(fd)
+
+        os.replace(self.partial_path, self.path)
+        _remove(self.state_path)
+        _remove(self.manifest_path)
+
+        for algorithm, hasher in hashers.items():
+            cache_checksum(self.path, algorithm, hasher.hexdigest())
+
+        logger.debug('Merged %s chunks into %s' % (len(remaining), self.path))
+        return done
+
+
+class UploadSession:
+    """
+    Keeps track of the data uploaded to an information package from the
+    time it enters the "Uploading" state until it is set as uploaded.
+
+    The session is stored in the cache so that receiving a chunk never has
+    to write to the information package row.
+    """
+
+    CACHE_KEY = 'etp_upload_session:{ip}:{field}'
+
+    def __init__(self, ip):
+        self.ip = str(ip)
+
+    def _get_key(self, field):
+        return self.CACHE_KEY.format(ip=self.ip, field=field)
+
+    def begin(self):
+        cache.set(self._get_key('started'), timezone.now())
+        cache.set(self._get_key('bytes'), 0)
+        cache.set(self._get_key('chunks'), 0)
+
+    def add_chunk(self, size):
+        for field, delta in (('bytes', size), ('chunks', 1)):
+            key = self._get_key(field)
+            cache.add(key, 0)
+            cache.incr(key, delta)
+
+    def get(self):
+        return {
+            'started': cache.get(self._get_key('started')),
+            'bytes_received': cache.get(self._get_key('bytes'), 0),
+            'chunks_received': cache.get(self._get_key('chunks'), 0),
+        }
+
+    def end(self):
+        cache.delete_many([self._get_key(field) for field in ('started', 'bytes', 'chunks')])
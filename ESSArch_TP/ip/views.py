@@ -28,18 +28,19 @@ import logging
 import os
 import shutil
 
+from celery import states as celery_states
 from django.conf import settings
 from django.core.exceptions import ValidationError
 from django.db import IntegrityError, transaction
+from django.db.models import Prefetch
 from django.http import HttpResponse
 from groups_manager.utils import get_permission_name
 from guardian.shortcuts import assign_perm
-from rest_framework import exceptions, permissions, status
+from rest_framework import exceptions, permissions, serializers, status
 from rest_framework.decorators import action
 from rest_framework.response import Response
 
-from ESSArch_Core.WorkflowEngine.models import ProcessStep, ProcessTask
-from ESSArch_Core.WorkflowEngine.util import create_workflow
+from ESSArch_Core.WorkflowEngine.models import ProcessTask
 from ESSArch_Core.auth.decorators import permission_required_or_403
 from ESSArch_Core.auth.models import Member
 from ESSArch_Core.configuration.models import Path
@@ -50,9 +51,22 @@ from ESSArch_Core.ip.permissions import CanCreateSIP, CanSetUploaded, CanSubmitS
 from ESSArch_Core.ip.views import InformationPackageViewSet as InformationPackageViewSetCore
 from ESSArch_Core.mixins import GetObjectForUpdateViewMixin
 from ESSArch_Core.profiles.models import ProfileIP
-from ESSArch_Core.util import find_destination, in_directory, merge_file_chunks, normalize_path
+from ESSArch_Core.util import find_destination, in_directory, normalize_path
+from workflow.util import create_workflow
 
 from .serializers import InformationPackageSerializer, InformationPackageReadSerializer
+from .uploads import ChunkedUpload, MissingChunkError, UploadSession, get_ranges
+
+
+def get_chunk_number(params):
+    try:
+        number = int(params['flowChunkNumber'])
+    except (KeyError, TypeError, ValueError):
+        raise exceptions.ParseError('flowChunkNumber must be an integer')
+
+    if number < 0:
+        raise exceptions.ParseError('flowChunkNumber must not be negative')
+    return number
 
 
 class InformationPackageViewSet(InformationPackageViewSetCore, GetObjectForUpdateViewMixin):
@@ -61,6 +75,15 @@ class InformationPackageViewSet(InformationPackageViewSetCore, GetObjectForUpdat
     """
     logger = logging.getLogger('essarch.etp.InformationPackageViewSet')
 
+    def get_queryset(self):
+        queryset = super().get_queryset()
+
+        if self.action == 'list':
+            profiles = ProfileIP.objects.select_related('profile', 'LockedBy')
+            queryset = queryset.prefetch_related(Prefetch('profileip_set', queryset=profiles, to_attr='profiles'))
+
+        return queryset
+
     def get_serializer_class(self):
         if self.request.method in permissions.SAFE_METHODS:
             return InformationPackageReadSerializer
@@ -297,50 +320,68 @@ class InformationPackageViewSet(InformationPackageViewSetCore, GetObjectForUpdat
         if ip.state != 'Preparing':
             raise exceptions.ParseError('IP must be in state "Preparing"')
 
+        if ProcessTask.objects.filter(
+            information_package=ip,
+            name__in=["ESSArch_Core.ip.tasks.CreatePhysicalModel", "preingest.tasks.CreatePhysicalModel"],
+            status__in=[celery_states.PENDING, celery_states.STARTED],
+        ).exists():
+            raise Conflict('Information package is already being prepared')
+
         if sa is None or not ip.submission_agreement_locked:
             raise exceptions.ParseError('IP requires locked SA to be prepared')
 
-        profile_ip_sip = ProfileIP.objects.filter(ip=ip, profile=sa.profile_sip).first()
-        profile_ip_transfer_project = ProfileIP.objects.filter(ip=ip, profile=sa.profile_transfer_project).first()
-        profile_ip_submit_description = ProfileIP.objects.filter(ip=ip, profile=sa.profile_submit_description).first()
+        profile_ips = list(ProfileIP.objects.filter(ip=ip).select_related('profile'))
+        profile_ids = {profile_ip.profile_id for profile_ip in profile_ips}
+        errors = []
 
-        if profile_ip_sip is None:
-            raise exceptions.ParseError('Information package missing SIP profile')
-        if profile_ip_transfer_project is None:
-            raise exceptions.ParseError('Information package missing Transfer Project profile')
-        if profile_ip_submit_description is None:
-            raise exceptions.ParseError('Information package missing Submit Description profile')
+        for profile_name, profile_id in (
+            ('SIP', sa.profile_sip_id),
+            ('Transfer Project', sa.profile_transfer_project_id),
+            ('Submit Description', sa.profile_submit_description_id),
+        ):
+            if profile_id is None or profile_id not in profile_ids:
+                errors.append('Information package missing %s profile' % profile_name)
 
-        for profile_ip in ProfileIP.objects.filter(ip=ip).iterator():
+        for profile_ip in profile_ips:
             try:
                 profile_ip.clean()
             except ValidationError as e:
-                raise exceptions.ParseError('%s: %s' % (profile_ip.profile.name, e[0]))
+                errors.append('%s: %s' % (profile_ip.profile.name, ' '.join(e.messages)))
 
-            profile_ip.LockedBy = request.user
-            profile_ip.save()
-
-        step = ProcessStep.objects.create(
-            name="Create Physical Model",
-            information_package=ip
-        )
-        ProcessTask.objects.create(
-            name="ESSArch_Core.ip.tasks.CreatePhysicalModel",
-            information_package=ip,
-            responsible=self.request.user,
-            processstep=step,
-        )
+        if errors:
+            raise exceptions.ParseError({'detail': errors})
 
-        step.run().get()
+        ProfileIP.objects.filter(pk__in=[profile_ip.pk for profile_ip in profile_ips]).update(LockedBy=request.user)
 
-        submit_description_data = ip.get_profile_data('submit_description')
-        ip.start_date = submit_description_data.get('start_date')
-        ip.end_date = submit_description_data.get('end_date')
+        workflow_spec = [
+            {
+                "name": "preingest.tasks.CreatePhysicalModel",
+                "label": "Create Physical Model",
+            },
+            {
+                "name": "preingest.tasks.SetSubmitDescriptionDates",
+                "label": "Set start and end dates",
+            },
+            {
+                "name": "ESSArch_Core.tasks.UpdateIPStatus",
+                "label": "Set status to prepared",
+                "args": ["Prepared"],
+            },
+        ]
+        workflow = create_workflow(workflow_spec, ip)
+        workflow.name = "Prepare IP"
+        workflow.information_package = ip
+        workflow.save()
 
-        ip.state = "Prepared"
-        ip.save(update_fields=['state', 'start_date', 'end_date'])
+        # start when the profiles are locked and the IP row is released,
+        # progress is followed through the step. CreatePhysicalModel unlocks
+        # the profiles if it fails.
+        transaction.on_commit(workflow.run)
 
-        return Response()
+        return Response(
+            {'detail': 'Preparing information package', 'step': str(workflow.pk)},
+            status=status.HTTP_202_ACCEPTED,
+        )
 
     @transaction.atomic
     @action(detail=True, methods=['post'], url_path='create', permission_classes=[CanCreateSIP])
@@ -384,42 +425,54 @@ class InformationPackageViewSet(InformationPackageViewSetCore, GetObjectForUpdat
                 "label": "Convert Files",
                 "args": ["{{_OBJPATH}}", file_format_map]
             },
+            {
+                "name": "preingest.tasks.CalculateChecksums",
+                "label": "Calculate checksums",
+            },
             {
                 "name": "ESSArch_Core.ip.tasks.DownloadSchemas",
                 "label": "Download Schemas",
             },
             {
                 "step": True,
-                "name": "Create Log File",
+                "name": "Create Metadata Files",
+                "parallel": True,
                 "children": [
                     {
-                        "name": "ESSArch_Core.ip.tasks.GenerateEventsXML",
-                        "label": "Generate events xml file",
+                        "step": True,
+                        "name": "Create Log File",
+                        "children": [
+                            {
+                                "name": "ESSArch_Core.ip.tasks.GenerateEventsXML",
+                                "label": "Generate events xml file",
+                            },
+                            {
+                                "name": "ESSArch_Core.tasks.AppendEvents",
+                                "label": "Add events to xml file",
+                            },
+                            {
+                                "name": "ESSArch_Core.ip.tasks.AddPremisIPObjectElementToEventsFile",
+                                "label": "Add premis IP object to xml file",
+                            },
+
+                        ]
                     },
                     {
-                        "name": "ESSArch_Core.tasks.AppendEvents",
-                        "label": "Add events to xml file",
-                    },
-                    {
-                        "name": "ESSArch_Core.ip.tasks.AddPremisIPObjectElementToEventsFile",
-                        "label": "Add premis IP object to xml file",
+                        "name": "ESSArch_Core.ip.tasks.GeneratePremis",
+                        "if": generate_premis,
+                        "label": "Generate premis",
                     },
-
                 ]
             },
             {
-                "name": "ESSArch_Core.ip.tasks.GeneratePremis",
-                "if": generate_premis,
-                "label": "Generate premis",
-            },
-            {
-                "name": "ESSArch_Core.ip.tasks.GenerateContentMets",
+                "name": "preingest.tasks.GenerateContentMets",
                 "label": "Generate content-mets",
             },
             {
                 "step": True,
                 "name": "Validation",
                 "if": any([validate_xml_file, validate_logical_physical_representation]),
+                "parallel": True,
                 "children": [
                     {
                         "name": "ESSArch_Core.tasks.ValidateXMLFile",
@@ -438,7 +491,7 @@ class InformationPackageViewSet(InformationPackageViewSetCore, GetObjectForUpdat
                         }
                     },
                     {
-                        "name": "ESSArch_Core.tasks.ValidateLogicalPhysicalRepresentation",
+                        "name": "preingest.tasks.ValidateLogicalPhysicalRepresentation",
                         "if": validate_logical_physical_representation,
                         "label": "Diff-check against content-mets",
                         "args": ["{{_OBJPATH}}", "{{_CONTENT_METS_PATH}}"],
@@ -452,7 +505,7 @@ class InformationPackageViewSet(InformationPackageViewSetCore, GetObjectForUpdat
                 ]
             },
             {
-                "name": "ESSArch_Core.ip.tasks.CreateContainer",
+                "name": "preingest.tasks.CreateContainer",
                 "label": "Create container",
             },
             {
@@ -519,22 +572,30 @@ class InformationPackageViewSet(InformationPackageViewSetCore, GetObjectForUpdat
 
         workflow_spec = [
             {
-                "name": "ESSArch_Core.ip.tasks.GeneratePackageMets",
+                "name": "preingest.tasks.GeneratePackageMets",
                 "label": "Generate package-mets",
             },
             {
-                "name": "ESSArch_Core.tasks.ValidateXMLFile",
-                "if": validate_xml_file,
-                "label": "Validate package-mets",
-                "params": {
-                    "xml_filename": "{{_PACKAGE_METS_PATH}}",
-                }
-            },
-            {
-                "name": "ESSArch_Core.tasks.ValidateLogicalPhysicalRepresentation",
-                "if": validate_logical_physical_representation,
-                "label": "Diff-check against package-mets",
-                "args": ["{{_OBJPATH}}", "{{_PACKAGE_METS_PATH}}"],
+                "step": True,
+                "name": "Validation",
+                "if": any([validate_xml_file, validate_logical_physical_representation]),
+                "parallel": True,
+                "children": [
+                    {
+                        "name": "ESSArch_Core.tasks.ValidateXMLFile",
+                        "if": validate_xml_file,
+                        "label": "Validate package-mets",
+                        "params": {
+                            "xml_filename": "{{_PACKAGE_METS_PATH}}",
+                        }
+                    },
+                    {
+                        "name": "preingest.tasks.ValidateLogicalPhysicalRepresentation",
+                        "if": validate_logical_physical_representation,
+                        "label": "Diff-check against package-mets",
+                        "args": ["{{_OBJPATH}}", "{{_PACKAGE_METS_PATH}}"],
+                    },
+                ]
             },
             {
                 "name": "preingest.tasks.SubmitSIP",
@@ -590,43 +651,89 @@ class InformationPackageViewSet(InformationPackageViewSetCore, GetObjectForUpdat
             )
         })
 
+    def begin_upload(self, ip):
+        """
+        Moves the IP to the "Uploading" state and starts a new upload
+        session, unless that already has been done by an earlier request
+        """
+
+        if ip.state == 'Uploading':
+            return
+
+        # conditional update to not start two sessions when concurrent
+        # requests begin the upload
+        started = InformationPackage.objects.filter(pk=ip.pk, state='Prepared').update(state='Uploading')
+        ip.state = 'Uploading'
+        if started:
+            UploadSession(ip.pk).begin()
+
     @action(detail=True, methods=['get', 'post'], url_path='upload', permission_classes=[CanUpload])
     def upload(self, request, pk=None):
         ip = self.get_object()
         if ip.state not in ['Prepared', 'Uploading']:
             raise exceptions.ParseError('IP must be in state "Prepared" or "Uploading"')
 
-        ip.state = "Uploading"
-        ip.save()
+        self.begin_upload(ip)
 
         if request.method == 'GET':
             dst = request.GET.get('destination', '').strip('/ ')
             path = os.path.join(dst, request.GET.get('flowRelativePath', ''))
-            chunk_nr = request.GET.get('flowChunkNumber')
-            chunk_path = "%s_%s" % (path, chunk_nr)
+            chunk_nr = get_chunk_number(request.GET)
 
-            if os.path.exists(os.path.join(ip.object_path, chunk_path)):
+            if ChunkedUpload(os.path.join(ip.object_path, path)).has_chunk(chunk_nr):
                 return HttpResponse(status=200)
             return HttpResponse(status=204)
 
         if request.method == 'POST':
             dst = request.data.get('destination', '').strip('/ ')
             path = os.path.join(dst, request.data.get('flowRelativePath', ''))
-            chunk_nr = request.data.get('flowChunkNumber')
-            chunk_path = "%s_%s" % (path, chunk_nr)
-            chunk_path = os.path.join(ip.object_path, chunk_path)
+            chunk_nr = get_chunk_number(request.data)
 
             chunk = request.FILES['file']
+            upload = ChunkedUpload(os.path.join(ip.object_path, path))
+            if upload.write_chunk(chunk_nr, chunk):
+                UploadSession(ip.pk).add_chunk(chunk.size)
 
-            if not os.path.exists(os.path.dirname(chunk_path)):
-                os.makedirs(os.path.dirname(chunk_path), exist_ok=True)
-
-            with open(chunk_path, 'wb+') as dst:
-                for c in chunk.chunks():
-                    dst.write(c)
+            # Flow.js clients number their chunks from 1, which allows us
+            # to fold chunks into the file as they arrive in order
+            if 'flowTotalChunks' in request.data:
+                upload.fold()
 
             return Response("Uploaded chunk")
 
+    @action(detail=True, methods=['get'], url_path='uploaded-chunks', permission_classes=[CanUpload])
+    def uploaded_chunks(self, request, pk=None):
+        """
+        Lists the chunks of a file that already have been uploaded, as
+        inclusive ranges of chunk numbers. Allows a client to resume an
+        upload without testing each chunk separately.
+        """
+
+        ip = self.get_object()
+        if ip.state not in ['Prepared', 'Uploading']:
+            raise exceptions.ParseError('IP must be in state "Prepared" or "Uploading"')
+
+        if 'flowRelativePath' not in request.query_params:
+            raise exceptions.ParseError('flowRelativePath parameter missing')
+
+        dst = request.query_params.get('destination', '').strip('/ ')
+        path = os.path.join(dst, request.query_params['flowRelativePath'])
+        fullpath = os.path.join(ip.object_path, path)
+
+        if not in_directory(fullpath, ip.object_path):
+            raise exceptions.ParseError('Illegal path %s' % path)
+
+        chunks = ChunkedUpload(fullpath).get_uploaded_chunks()
+        return Response({'count': len(chunks), 'chunks': get_ranges(chunks)})
+
+    @action(detail=True, methods=['get'], url_path='upload-session', permission_classes=[CanUpload])
+    def upload_session(self, request, pk=None):
+        ip = self.get_object()
+        if ip.state != 'Uploading':
+            raise exceptions.ParseError('IP must be in state "Uploading"')
+
+        return Response(UploadSession(ip.pk).get())
+
     @action(detail=True, methods=['post'], url_path='merge-uploaded-chunks', permission_classes=[CanUpload])
     def merge_uploaded_chunks(self, request, pk=None):
         ip = self.get_object()
@@ -635,10 +742,27 @@ class InformationPackageViewSet(InformationPackageViewSetCore, GetObjectForUpdat
 
         path = os.path.join(ip.object_path, request.data['path'])
 
+        # form posts send the flag as a string, e.g. "false"
+        background = serializers.BooleanField().to_internal_value(request.data.get('background', False))
+        if background:
+            t = ProcessTask.objects.create(
+                name='preingest.tasks.MergeUploadedChunks',
+                params={'path': path},
+                eager=False,
+                information_package=ip,
+                responsible=request.user,
+            )
+            t.run()
+            return Response({"detail": "Merging chunks", "task": t.pk}, status=status.HTTP_202_ACCEPTED)
+
         try:
-            merge_file_chunks(path)
+            ChunkedUpload(path).merge()
         except NoFileChunksFound:
             raise exceptions.NotFound('No chunks found')
+        except MissingChunkError as e:
+            raise exceptions.ParseError(str(e))
+        except TimeoutError:
+            raise Conflict('Chunks are already being merged')
 
         logger = logging.getLogger('essarch')
         extra = {'event_type': 50700, 'object': str(ip.pk), 'agent': request.user.username, 'outcome': EventIP.SUCCESS}
@@ -654,11 +778,12 @@ class InformationPackageViewSet(InformationPackageViewSetCore, GetObjectForUpdat
             raise exceptions.ParseError('IP must be in state "Prepared" or "Uploading"')
 
         ProcessTask.objects.create(
-            name="ESSArch_Core.tasks.UpdateIPSizeAndCount",
+            name="preingest.tasks.UpdateIPSizeAndCount",
             eager=False,
             information_package=ip
         ).run()
 
         ip.state = "Uploaded"
         ip.save()
+        UploadSession(ip.pk).end()
         return Response()
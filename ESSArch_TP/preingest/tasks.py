@@ -23,32 +23,55 @@
 """
 
 import os
-import shutil
 from urllib.parse import urljoin
 
 import requests
+from django.conf import settings
 from django.db import transaction
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # noinspection PyUnresolvedReferences
 from ESSArch_Core import tasks  # noqa
 from ESSArch_Core.WorkflowEngine.dbtask import DBTask
 from ESSArch_Core.configuration.models import Path
 from ESSArch_Core.ip.models import Agent, InformationPackage
+from ESSArch_Core.ip.tasks import CreatePhysicalModel as CoreCreatePhysicalModel
+from ESSArch_Core.ip.tasks import GenerateContentMets as CoreGenerateContentMets
+from ESSArch_Core.ip.tasks import GeneratePackageMets as CoreGeneratePackageMets
 from ESSArch_Core.ip.utils import get_cached_objid
-from ESSArch_Core.storage.copy import copy_file
+from ESSArch_Core.profiles.models import ProfileIP
+from ESSArch_Core.tasks import (
+    ValidateLogicalPhysicalRepresentation as CoreValidateLogicalPhysicalRepresentation,
+)
+
+from fixity.checksum import cache_tree_checksums, calculate_checksum, recorded_checksums
+from ip.uploads import ChunkedUpload
+from storage.container import write_container
+from storage.copy import DEFAULT_BLOCK_SIZE, TransferCheckpoint, copy_file, copy_tree
 
 
 class ReceiveSIP(DBTask):
     event_type = 20100
 
-    @transaction.atomic
     def run(self):
         ip = InformationPackage.objects.get(pk=self.ip)
-        sa = ip.submission_agreement
         prepare_path = Path.objects.get(entity="path_preingest_prepare").value
         dst_dir = os.path.join(prepare_path, ip.object_identifier_value)
-        shutil.copytree(ip.object_path, dst_dir)
 
+        # copy outside of the transaction, it can take a long time for
+        # large IPs and only the metadata update needs to be atomic
+        copy_tree(
+            ip.object_path, dst_dir,
+            workers=getattr(settings, 'RECEIVE_SIP_COPY_WORKERS', None),
+            progress_callback=self.set_progress,
+        )
+
+        with transaction.atomic():
+            self.update_metadata(ip, dst_dir)
+
+    def update_metadata(self, ip, dst_dir):
+        sa = ip.submission_agreement
         if sa.archivist_organization:
             existing_agents_with_notes = Agent.objects.all().with_notes([])
             ao_agent, _ = Agent.objects.get_or_create(
@@ -69,19 +92,204 @@ class ReceiveSIP(DBTask):
         return "Received IP"
 
 
+class CalculateChecksums(DBTask):
+    """
+    Records the checksums of the files in the IP that weren't recorded when
+    they were uploaded, reading each file once for all algorithms, so that
+    the tasks generating and validating the metadata don't read them again
+    """
+
+    def run(self):
+        ip = InformationPackage.objects.get(pk=self.ip)
+        cache_tree_checksums(ip.object_path)
+
+    def event_outcome_success(self):
+        return "Calculated checksums of %s" % get_cached_objid(self.ip)
+
+
+class UpdateIPSizeAndCount(DBTask):
+    def run(self):
+        ip = InformationPackage.objects.get(pk=self.ip)
+        size = count = 0
+        for root, _, files in os.walk(ip.object_path):
+            for name in files:
+                size += os.path.getsize(os.path.join(root, name))
+                count += 1
+
+        ip.object_size = size
+        ip.object_num_items = count
+        ip.save(update_fields=['object_size', 'object_num_items'])
+
+    def event_outcome_success(self):
+        return "Updated size and count of %s" % get_cached_objid(self.ip)
+
+
+class CreatePhysicalModel(CoreCreatePhysicalModel):
+    """
+    The profiles of the IP are locked before the workflow creating the
+    physical model starts. They are unlocked if it fails or is undone, so
+    that they can be corrected before preparing the IP again.
+    """
+
+    def unlock_profiles(self):
+        ProfileIP.objects.filter(ip_id=self.ip).update(LockedBy=None)
+
+    def run(self, *args, **kwargs):
+        try:
+            return super().run(*args, **kwargs)
+        except Exception:
+            self.unlock_profiles()
+            raise
+
+    def undo(self, *args, **kwargs):
+        result = super().undo(*args, **kwargs)
+        self.unlock_profiles()
+        return result
+
+
+class SetSubmitDescriptionDates(DBTask):
+    event_type = 10100
+
+    def run(self):
+        ip = InformationPackage.objects.get(pk=self.ip)
+        submit_description_data = ip.get_profile_data('submit_description')
+        ip.start_date = submit_description_data.get('start_date')
+        ip.end_date = submit_description_data.get('end_date')
+        ip.save(update_fields=['start_date', 'end_date'])
+
+    def event_outcome_success(self):
+        return "Set start and end dates of %s" % get_cached_objid(self.ip)
+
+
+class MergeUploadedChunks(DBTask):
+    event_type = 50700
+
+    def run(self, path):
+        ChunkedUpload(path).merge(progress_callback=self.set_progress)
+
+        # merge only hashes the file if no chunks were folded, calculate and
+        # record the checksums here instead of when the IP is created
+        for algorithm in getattr(settings, 'UPLOAD_CHECKSUM_ALGORITHMS', []):
+            calculate_checksum(path, algorithm)
+
+    def event_outcome_success(self, path):
+        return "Uploaded %s" % path
+
+
+class GenerateContentMets(CoreGenerateContentMets):
+    def run(self, *args, **kwargs):
+        with recorded_checksums():
+            return super().run(*args, **kwargs)
+
+
+class GeneratePackageMets(CoreGeneratePackageMets):
+    def run(self, *args, **kwargs):
+        with recorded_checksums():
+            return super().run(*args, **kwargs)
+
+
+class ValidateLogicalPhysicalRepresentation(CoreValidateLogicalPhysicalRepresentation):
+    def run(self, *args, **kwargs):
+        with recorded_checksums():
+            return super().run(*args, **kwargs)
+
+
+class CreateContainer(DBTask):
+    def get_compression_options(self, transfer_project):
+        """
+        Returns the level and number of threads used to compress the
+        container, from the transfer project profile or else the settings
+        """
+
+        try:
+            data = transfer_project.specification_data or {}
+        except AttributeError:
+            data = {}
+
+        options = {}
+        for name in ['level', 'threads']:
+            # 0 is a valid compression level
+            value = data.get('container_compression_%s' % name)
+            if value is None:
+                value = getattr(settings, 'CONTAINER_COMPRESSION_%s' % name.upper(), None)
+            options['compression_%s' % name] = int(value) if value is not None else None
+
+        return options
+
+    def run(self, src=None, dst=None):
+        ip = InformationPackage.objects.get(pk=self.ip)
+        container_format = ip.get_container_format()
+        transfer_project = ip.get_profile('transfer_project')
+
+        if src is None:
+            src = ip.object_path
+        if dst is None:
+            reception = Path.objects.get(entity="path_preingest_reception").value
+            dst = os.path.join(reception, ip.object_identifier_value + ".%s" % container_format)
+
+        # the checksums of the container are calculated while it is written
+        # and reused when generating the package METS and submitting it
+        write_container(
+            src, dst, container_format, arcname=ip.object_identifier_value,
+            algorithms=getattr(settings, 'CONTAINER_CHECKSUM_ALGORITHMS', ['SHA-256', 'MD5']),
+            progress_callback=self.set_progress,
+            **self.get_compression_options(transfer_project)
+        )
+
+        # like Core, the IP is now represented by the container
+        ip.object_path = dst
+        ip.save(update_fields=['object_path'])
+        return dst
+
+    def event_outcome_success(self, src=None, dst=None):
+        return "Created container for %s" % get_cached_objid(self.ip)
+
+
 class SubmitSIP(DBTask):
     event_type = 10500
 
+    def get_transfer_block_size(self, transfer_project):
+        try:
+            block_size = transfer_project.specification_data.get('transfer_block_size')
+        except AttributeError:
+            block_size = None
+
+        return int(block_size or DEFAULT_BLOCK_SIZE)
+
+    def get_requests_session(self, remote_user, remote_pass):
+        session = requests.Session()
+        session.verify = False
+        session.auth = (remote_user, remote_pass)
+
+        # keep the connection alive between chunks and retry failed
+        # connection attempts, resending chunks is left to copy_file
+        adapter = HTTPAdapter(max_retries=Retry(total=None, connect=5, read=0, backoff_factor=1))
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def report_progress(self, offset, total):
+        """
+        Returns a callback that reports the progress of copying a file that
+        starts at ``offset`` of all ``total`` bytes being transferred
+        """
+
+        def callback(copied, size):
+            if total:
+                self.set_progress(offset + copied, total=total)
+
+        return callback
+
     def run(self):
         ip = InformationPackage.objects.get(pk=self.ip)
 
         srcdir = Path.objects.get(entity="path_preingest_reception").value
         reception = Path.objects.get(entity="path_ingest_reception").value
         container_format = ip.get_container_format()
-        src = os.path.join(srcdir, ip.object_identifier_value + ".%s" % container_format)
+        transfer_project = ip.get_profile('transfer_project')
 
         try:
-            remote = ip.get_profile('transfer_project').specification_data.get(
+            remote = transfer_project.specification_data.get(
                 'preservation_organization_receiver_url'
             )
         except AttributeError:
@@ -91,23 +299,32 @@ class SubmitSIP(DBTask):
 
         if remote:
             try:
-                dst, remote_user, remote_pass = remote.split(',')
-                dst = urljoin(dst, 'api/ip-reception/upload/')
-
-                session = requests.Session()
-                session.verify = False
-                session.auth = (remote_user, remote_pass)
+                remote_dst, remote_user, remote_pass = remote.split(',')
+                remote_dst = urljoin(remote_dst, 'api/ip-reception/upload/')
+                session = self.get_requests_session(remote_user, remote_pass)
             except ValueError:
                 remote = None
-        else:
-            dst = os.path.join(reception, ip.object_identifier_value + ".%s" % container_format)
-        block_size = 8 * 1000000  # 8MB
-        copy_file(src, dst, requests_session=session, block_size=block_size)
 
-        src = os.path.join(srcdir, ip.object_identifier_value + ".xml")
-        if not remote:
-            dst = os.path.join(reception, ip.object_identifier_value + ".xml")
-        copy_file(src, dst, requests_session=session, block_size=block_size)
+        block_size = self.get_transfer_block_size(transfer_project)
+        srcs = [
+            os.path.join(srcdir, ip.object_identifier_value + ".%s" % container_format),
+            os.path.join(srcdir, ip.object_identifier_value + ".xml"),
+        ]
+        total = sum(os.path.getsize(src) for src in srcs)
+        offset = 0
+
+        for src in srcs:
+            if remote:
+                dst = remote_dst
+            else:
+                dst = os.path.join(reception, os.path.basename(src))
+
+            copy_file(
+                src, dst, requests_session=session, block_size=block_size,
+                progress_callback=self.report_progress(offset, total),
+                allow_hardlink=getattr(settings, 'SUBMIT_SIP_HARDLINK', False),
+            )
+            offset += os.path.getsize(src)
 
         self.set_progress(100, total=100)
 
@@ -117,11 +334,14 @@ class SubmitSIP(DBTask):
         reception = Path.objects.get(entity="path_ingest_reception").value
         container_format = ip.get_container_format()
 
+        srcdir = Path.objects.get(entity="path_preingest_reception").value
+
         tar = os.path.join(reception, ip.object_identifier_value + ".%s" % container_format)
         xml = os.path.join(reception, ip.object_identifier_value + ".xml")
 
-        os.remove(tar)
-        os.remove(xml)
+        for dst in [tar, xml]:
+            TransferCheckpoint(os.path.join(srcdir, os.path.basename(dst)), dst).clear()
+            os.remove(dst)
 
     def event_outcome_success(self):
         return "Submitted %s" % get_cached_objid(self.ip)
@@ -24,10 +24,11 @@
 
 import os
 import shutil
+from unittest import mock
 
 from django.conf import settings
 from django.contrib.auth.models import User
-from django.test import TransactionTestCase
+from django.test import SimpleTestCase, TransactionTestCase, override_settings
 
 from ESSArch_Core.configuration.models import (
     EventType, Path,
@@ -41,6 +42,8 @@ from ESSArch_Core.WorkflowEngine.models import (
     ProcessTask,
 )
 
+from preingest.tasks import CreateContainer, CreatePhysicalModel, SubmitSIP
+
 
 class test_tasks(TransactionTestCase):
     def setUp(self):
@@ -194,6 +197,27 @@ class test_tasks(TransactionTestCase):
             os.path.isdir(os.path.join(path, 'dir2'))
         )
 
+    @mock.patch('preingest.tasks.InformationPackage.get_profile', return_value=None)
+    @mock.patch('preingest.tasks.InformationPackage.get_container_format', return_value='tar')
+    def test_create_container(self, mock_format, mock_profile):
+        objpath = os.path.join(self.prepare_path, 'ip1')
+        os.makedirs(os.path.join(objpath, 'content'))
+        with open(os.path.join(objpath, 'content', 'foo.txt'), 'w') as f:
+            f.write('foo')
+
+        ip = InformationPackage.objects.create(object_identifier_value='ip1', object_path=objpath)
+        task = ProcessTask.objects.create(
+            name="preingest.tasks.CreateContainer",
+            information_package=ip,
+        )
+        task.run()
+
+        container = os.path.join(self.preingest_reception, 'ip1.tar')
+        self.assertTrue(os.path.isfile(container))
+
+        ip.refresh_from_db()
+        self.assertEqual(ip.object_path, container)
+
     def test_submit_sip(self):
         ip = InformationPackage.objects.create(label="ip1")
 
@@ -219,3 +243,79 @@ class test_tasks(TransactionTestCase):
 
         self.assertFalse(os.path.isfile(dsttar))
         self.assertFalse(os.path.isfile(dstxml))
+
+
+class SubmitSIPTransferOptionsTests(SimpleTestCase):
+    @mock.patch('preingest.tasks.SubmitSIP.set_progress')
+    def test_progress_includes_previous_files(self, mock_progress):
+        callback = SubmitSIP().report_progress(100, 1000)
+        callback(200, 800)
+        mock_progress.assert_called_once_with(300, total=1000)
+
+    @mock.patch('preingest.tasks.SubmitSIP.set_progress')
+    def test_no_progress_without_data(self, mock_progress):
+        callback = SubmitSIP().report_progress(0, 0)
+        callback(0, 0)
+        mock_progress.assert_not_called()
+
+    def test_transfer_block_size(self):
+        transfer_project = mock.Mock(specification_data={'transfer_block_size': '32000000'})
+        self.assertEqual(SubmitSIP().get_transfer_block_size(transfer_project), 32000000)
+        self.assertEqual(SubmitSIP().get_transfer_block_size(None), 8 * 1000000)
+
+
+@mock.patch('preingest.tasks.ProfileIP.objects.filter')
+class CreatePhysicalModelUnlockTests(SimpleTestCase):
+    def setUp(self):
+        self.task = CreatePhysicalModel()
+        self.task.ip = 'ip'
+
+    @mock.patch('preingest.tasks.CoreCreatePhysicalModel.run', side_effect=OSError)
+    def test_unlock_profiles_on_failure(self, mock_run, mock_filter):
+        with self.assertRaises(OSError):
+            self.task.run()
+
+        mock_filter.assert_called_once_with(ip_id='ip')
+        mock_filter.return_value.update.assert_called_once_with(LockedBy=None)
+
+    @mock.patch('preingest.tasks.CoreCreatePhysicalModel.run')
+    def test_profiles_stay_locked_on_success(self, mock_run, mock_filter):
+        self.task.run()
+        mock_filter.assert_not_called()
+
+    @mock.patch('preingest.tasks.CoreCreatePhysicalModel.undo')
+    def test_unlock_profiles_on_undo(self, mock_undo, mock_filter):
+        self.task.undo()
+        mock_filter.return_value.update.assert_called_once_with(LockedBy=None)
+
+
+class CreateContainerCompressionOptionsTests(SimpleTestCase):
+    @override_settings(CONTAINER_COMPRESSION_LEVEL=6, CONTAINER_COMPRESSION_THREADS=None)
+    def test_from_transfer_project(self):
+        transfer_project = mock.Mock(specification_data={
+            'container_compression_level': '9',
+            'container_compression_threads': 4,
+        })
+        self.assertEqual(CreateContainer().get_compression_options(transfer_project), {
+            'compression_level': 9,
+            'compression_threads': 4,
+        })
+
+    @override_settings(CONTAINER_COMPRESSION_LEVEL=6, CONTAINER_COMPRESSION_THREADS=None)
+    def test_level_zero(self):
+        transfer_project = mock.Mock(specification_data={'container_compression_level': 0})
+        self.assertEqual(CreateContainer().get_compression_options(transfer_project), {
+            'compression_level': 0,
+            'compression_threads': None,
+        })
+
+        with self.settings(CONTAINER_COMPRESSION_LEVEL=0):
+            self.assertEqual(CreateContainer().get_compression_options(None)['compression_level'], 0)
+
+    @override_settings(CONTAINER_COMPRESSION_LEVEL=1, CONTAINER_COMPRESSION_THREADS=2)
+    def test_defaults_from_settings(self):
+        for transfer_project in [None, mock.Mock(specification_data={})]:
+            self.assertEqual(CreateContainer().get_compression_options(transfer_project), {
+                'compression_level': 1,
+                'compression_threads': 2,
+            })
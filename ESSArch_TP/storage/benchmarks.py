@@ -0,0 +1,114 @@
+"""
+    ESSArch is an open source archiving and digital preservation system
+
+    ESSArch Tools for Producer (ETP)
+    Copyright (C) 2005-2017 ES Solutions AB
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+    Contact information:
+    Web - http://www.essolutions.se
+    Email - essarch@essolutions.se
+"""
+
+
+# Compares the throughput of compressing containers with a single thread and
+# with ParallelGzipWriter, e.g. to choose the level and number of threads to
+# set in the transfer project profile:
+#
+#     python -m storage.benchmarks --size 512 --threads 1 2 4 8 --level 1 6
+
+import argparse
+import gzip
+import io
+import os
+import time
+
+from storage.compression import ParallelGzipWriter
+
+MB = 1024 * 1024
+
+
+def generate_data(size):
+    """
+    Returns ``size`` bytes that compress about as well as typical SIP
+    content, a mix of text and random bytes
+    """
+
+    text = b' '.join(b'<file id="%d" size="%d">content</file>' % (i, i * 7) for i in range(2000))
+    chunks = []
+    length = 0
+    while length < size:
+        chunk = text + os.urandom(len(text) // 2)
+        chunks.append(chunk)
+        length += len(chunk)
+    return b''.join(chunks)[:size]
+
+
+def _write(writer, data, block_size=MB):
+    view = memoryview(data)
+    for i in range(0, len(data), block_size):
+        writer.write(view[i:i + block_size])
+    writer.close()
+
+
+def benchmark_gzip(data, level):
+    out = io.BytesIO()
+    _write(gzip.GzipFile(fileobj=out, mode='wb', compresslevel=level, mtime=0), data)
+    return out.getbuffer().nbytes
+
+
+def benchmark_parallel_gzip(data, level, threads):
+    out = io.BytesIO()
+    _write(ParallelGzipWriter(out, level=level, threads=threads), data)
+    return out.getbuffer().nbytes
+
+
+def run(size, levels, threads, repeat):
+    data = generate_data(size * MB)
+    print('{:<16} {:>5} {:>7} {:>10} {:>7}'.format('writer', 'level', 'threads', 'MB/s', 'ratio'))
+
+    for level in levels:
+        cases = [('gzip', 1, lambda: benchmark_gzip(data, level))]
+        cases += [
+            ('parallel gzip', n, lambda n=n: benchmark_parallel_gzip(data, level, n))
+            for n in threads
+        ]
+
+        for name, n, func in cases:
+            best = None
+            for _ in range(repeat):
+                start = time.perf_counter()
+                compressed = func()
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+
+            print('{:<16} {:>5} {:>7} {:>10.1f} {:>7.3f}'.format(
+                name, level, n, len(data) / MB / best, compressed / len(data),
+            ))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark compression of containers')
+    parser.add_argument('--size', type=int, default=256, help='MB of data to compress')
+    parser.add_argument('--level', type=int, nargs='+', default=[6])
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 2, 4, os.cpu_count() or 1])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args(argv)
+
+    run(args.size, args.level, sorted(set(args.threads)), args.repeat)
+
+
+if __name__ == '__main__':
+    main()
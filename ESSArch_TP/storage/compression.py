@@ -0,0 +1,123 @@
+"""
+    ESSArch is an open source archiving and digital preservation system
+
+    ESSArch Tools for Producer (ETP)
+    Copyright (C) 2005-2017 ES Solutions AB
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+    Contact information:
+    Web - http://www.essolutions.se
+    Email - essarch@essolutions.se
+"""
+
+
+import gzip
+import io
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_COMPRESSION_BLOCK_SIZE = 1024 * 1024
+DEFAULT_COMPRESSION_LEVEL = 6
+
+
+def get_default_compression_threads():
+    return os.cpu_count() or 1
+
+
+def _compress(data, level):
+    # gzip.compress only takes mtime in Python 3.8 and later
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=level, mtime=0) as f:
+        f.write(data)
+    return buf.getvalue()
+
+
+class ParallelGzipWriter(io.RawIOBase):
+    """
+    A write-only stream that gzip compresses everything written to it using
+    a pool of threads, writing the result to ``fileobj``.
+
+    The input is split into blocks of ``block_size`` bytes that are
+    compressed independently, each into a gzip member of its own. The
+    members are written in order and a file of concatenated members is a
+    valid gzip file, readable by ``gzip``, ``tar`` and Python's ``gzip``
+    module. zlib releases the GIL while compressing so the blocks are
+    compressed in parallel. Compared to a single member the output is a few
+    bytes larger per block, and slightly less compressed since the history
+    isn't shared between blocks.
+
+    Closing the writer doesn't close ``fileobj``.
+    """
+
+    def __init__(self, fileobj, level=None, threads=None, block_size=DEFAULT_COMPRESSION_BLOCK_SIZE):
+        self.fileobj = fileobj
+        self.level = DEFAULT_COMPRESSION_LEVEL if level is None else int(level)
+        self.threads = int(threads or get_default_compression_threads())
+        self.block_size = block_size
+
+        self._buffer = bytearray()
+        self._pending = deque()
+        self._members = 0
+        self._executor = ThreadPoolExecutor(max_workers=self.threads)
+
+    def writable(self):
+        return True
+
+    def _submit(self, data):
+        # bound the number of blocks held in memory
+        while len(self._pending) >= self.threads * 2:
+            self._write_next()
+
+        self._pending.append(self._executor.submit(_compress, data, self.level))
+        self._members += 1
+
+    def _write_next(self):
+        self.fileobj.write(self._pending.popleft().result())
+
+    def write(self, b):
+        self._buffer += b
+        while len(self._buffer) >= self.block_size:
+            self._submit(bytes(self._buffer[:self.block_size]))
+            del self._buffer[:self.block_size]
+        return len(b)
+
+    def close(self):
+        self._close(finish=True)
+
+    def abort(self):
+        """
+        Closes the writer without writing anything more to ``fileobj``
+        """
+
+        self._close(finish=False)
+
+    def _close(self, finish):
+        if self.closed:
+            return
+
+        try:
+            # an empty gzip file isn't valid, it has at least one member
+            if finish and (self._buffer or not self._members):
+                self._submit(bytes(self._buffer))
+
+            while finish and self._pending:
+                self._write_next()
+        finally:
+            self._buffer.clear()
+            for future in self._pending:
+                future.cancel()
+            self._executor.shutdown(wait=True)
+            super().close()
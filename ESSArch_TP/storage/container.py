@@ -0,0 +1,228 @@
+"""
+    ESSArch is an open source archiving and digital preservation system
+
+    ESSArch Tools for Producer (ETP)
+    Copyright (C) 2005-2017 ES Solutions AB
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+    Contact information:
+    Web - http://www.essolutions.se
+    Email - essarch@essolutions.se
+"""
+
+
+import io
+import logging
+import os
+import tarfile
+import zipfile
+
+from fixity.checksum import cache_checksum, get_hasher, normalize_algorithm
+from storage.compression import ParallelGzipWriter
+from storage.copy import DEFAULT_BLOCK_SIZE, _remove, throttle_progress
+
+logger = logging.getLogger('essarch.etp.storage.container')
+
+CONTAINER_FORMATS = ('tar', 'tar.gz', 'tgz', 'zip')
+GZIP_FORMATS = ('tar.gz', 'tgz')
+
+
+class HashingWriter(io.RawIOBase):
+    """
+    A write-only, non-seekable stream that writes to ``fileobj`` and updates
+    ``hashers`` with everything written, so the checksums of a file are
+    known as soon as it has been written.
+
+    Being non-seekable makes ``tarfile`` and ``zipfile`` write their output
+    strictly in order, which is what makes the checksums valid.
+    """
+
+    def __init__(self, fileobj, hashers):
+        self.fileobj = fileobj
+        self.hashers = hashers
+        self.size = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.fileobj.write(b)
+        for hasher in self.hashers:
+            hasher.update(b)
+        self.size += len(b)
+        return len(b)
+
+    def tell(self):
+        return self.size
+
+    def flush(self):
+        self.fileobj.flush()
+
+
+def _walk(src):
+    """
+    Yields the path of every directory and file in ``src``, relative to
+    ``src`` and in a stable order, with its size
+    """
+
+    stack = ['']
+    while stack:
+        reldir = stack.pop()
+        with os.scandir(os.path.join(src, reldir)) as it:
+            entries = sorted(it, key=lambda entry: entry.name)
+
+        dirs = []
+        for entry in entries:
+            relpath = os.path.join(reldir, entry.name)
+            if entry.is_dir(follow_symlinks=False):
+                dirs.append(relpath)
+                yield relpath, True, 0
+            else:
+                yield relpath, False, entry.stat(follow_symlinks=False).st_size
+
+        stack.extend(reversed(dirs))
+
+
+class _ProgressReader:
+    def __init__(self, fileobj, callback):
+        self.fileobj = fileobj
+        self.callback = callback
+
+    def read(self, size=-1):
+        buf = self.fileobj.read(size)
+        self.callback(len(buf))
+        return buf
+
+
+def _add_to_tar(tar, path, arcname, size, block_size, progress):
+    tarinfo = tar.gettarinfo(path, arcname)
+    if tarinfo.isreg():
+        with open(path, 'rb', buffering=block_size) as f:
+            tar.addfile(tarinfo, _ProgressReader(f, progress))
+    else:
+        tar.addfile(tarinfo)
+
+
+def _add_to_zip(zf, path, arcname, size, block_size, progress):
+    zinfo = zipfile.ZipInfo.from_file(path, arcname)
+    if zinfo.is_dir():
+        zf.writestr(zinfo, b'')
+        return
+
+    with open(path, 'rb') as src, zf.open(zinfo, 'w', force_zip64=size >= zipfile.ZIP64_LIMIT) as dst:
+        while True:
+            buf = src.read(block_size)
+            if not buf:
+                break
+            dst.write(buf)
+            progress(len(buf))
+
+
+def _open_archive(fileobj, container_format):
+    if container_format != 'zip':
+        return tarfile.open(fileobj=fileobj, mode='w|', format=tarfile.PAX_FORMAT), _add_to_tar
+    return zipfile.ZipFile(fileobj, 'w', zipfile.ZIP_STORED, allowZip64=True), _add_to_zip
+
+
+def write_container(src, dst, container_format='tar', arcname=None, algorithms=None,
+                    block_size=DEFAULT_BLOCK_SIZE, progress_callback=None,
+                    compression_level=None, compression_threads=None):
+    """
+    Writes ``src`` to a tar, gzipped tar or zip file at ``dst`` in a single
+    pass over the files, calculating the checksums of the container while
+    it is written. Gzipped tar files are compressed using multiple threads,
+    see ``ParallelGzipWriter``.
+
+    The container is written next to ``dst`` and moved in place once it is
+    complete. The checksums are recorded with ``cache_checksum`` so that
+    tasks later reading the checksum of the container, e.g. when generating
+    the package METS or submitting it, don't read it again.
+
+    Args:
+        src: The directory to write
+        dst: The path of the container
+        container_format: ``tar``, ``tar.gz``, ``tgz`` or ``zip``
+        arcname: The name of the top directory in the container, defaults
+            to the name of ``src``
+        algorithms: The checksum algorithms to calculate
+        block_size: The size of each read from the files in ``src``
+        progress_callback: Called with the number of bytes of ``src``
+            written and the total size of ``src``, at most once per percent
+            and ``PROGRESS_INTERVAL``
+        compression_level: The gzip compression level
+        compression_threads: The number of threads compressing
+
+    Returns:
+        A dict with the checksum for each algorithm
+    """
+
+    container_format = container_format.lower()
+    if container_format not in CONTAINER_FORMATS:
+        raise ValueError('Unsupported container format: %s' % container_format)
+
+    if arcname is None:
+        arcname = os.path.basename(os.path.normpath(src))
+    algorithms = [normalize_algorithm(algorithm) for algorithm in algorithms or []]
+    hashers = [get_hasher(algorithm) for algorithm in algorithms]
+
+    entries = list(_walk(src))
+    total = sum(size for _, _, size in entries)
+    written = 0
+    if progress_callback is not None:
+        progress_callback = throttle_progress(progress_callback)
+
+    def progress(length):
+        nonlocal written
+        written += length
+        if progress_callback is not None and total:
+            progress_callback(written, total)
+
+    tmp = '%s.%s.tmp' % (dst, os.getpid())
+    try:
+        with open(tmp, 'wb') as f:
+            # the checksums are of the container as written to disk, i.e.
+            # after compression
+            writer = out = HashingWriter(f, hashers)
+            if container_format in GZIP_FORMATS:
+                out = ParallelGzipWriter(writer, level=compression_level, threads=compression_threads)
+
+            try:
+                buffered = io.BufferedWriter(out, buffer_size=block_size)
+                archive, add = _open_archive(buffered, container_format)
+                with archive:
+                    add(archive, src, arcname, 0, block_size, progress)
+                    for relpath, _, size in entries:
+                        path = os.path.join(src, relpath)
+                        add(archive, path, '/'.join([arcname] + relpath.split(os.sep)), size, block_size, progress)
+                buffered.flush()
+                out.close()
+            except BaseException:
+                if out is not writer:
+                    out.abort()
+                writer.close()
+                raise
+            os.fsync(f.fileno())
+        os.replace(tmp, dst)
+    except BaseException:
+        _remove(tmp)
+        raise
+
+    checksums = {}
+    for algorithm, hasher in zip(algorithms, hashers):
+        checksums[algorithm] = hasher.hexdigest()
+        cache_checksum(dst, algorithm, checksums[algorithm])
+
+    logger.info(u'Wrote {} entries of {} bytes to {} ({} bytes)'.format(len(entries), total, dst, writer.size))
+    return checksums
@@ -0,0 +1,803 @@
+"""
+    ESSArch is an open source archiving and digital preservation system
+
+    ESSArch Tools for Producer (ETP)
+    Copyright (C) 2005-2017 ES Solutions AB
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+    Contact information:
+    Web - http://www.essolutions.se
+    Email - essarch@essolutions.se
+"""
+
+import errno
+import json
+import logging
+import os
+import shutil
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from requests.exceptions import ConnectionError, Timeout
+from tenacity import before_sleep_log, retry, retry_if_exception_type, stop_after_attempt, wait_fixed
+
+from fixity.checksum import calculate_checksum
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+logger = logging.getLogger('essarch.etp.storage.copy')
+
+DEFAULT_BLOCK_SIZE = 8 * 1000000  # 8MB
+
+# Number of bytes copied locally between checkpoints, each span is handed to
+# the kernel at once to allow server-side copies
+CHECKPOINT_SIZE = 256 * 1000000  # 256MB
+
+# Number of files copied concurrently by copy_tree, same default as
+# ThreadPoolExecutor in Python 3.8
+DEFAULT_TREE_COPY_WORKERS = min(32, (os.cpu_count() or 1) + 4)
+
+# Largest amount of data that is handed to the kernel in a single zero-copy
+# call, see the notes on copy_file_range(2) and sendfile(2)
+MAX_ZERO_COPY_SIZE = 0x7ffff000
+
+# Errors that mean that the kernel or filesystem doesn't support the
+# zero-copy method used, the next method is tried instead
+ZERO_COPY_FALLBACK_ERRNOS = {
+    errno.EINVAL, errno.ENOSYS, errno.EXDEV, errno.ENOTSOCK,
+    getattr(errno, 'ENOTSUP', errno.EOPNOTSUPP), errno.EOPNOTSUPP,
+}
+
+# ioctl(2) request cloning a file on filesystems with reflink support,
+# e.g. btrfs and XFS, see ioctl_ficlone(2)
+FICLONE = 0x40049409
+REFLINK_FALLBACK_ERRNOS = ZERO_COPY_FALLBACK_ERRNOS | {errno.EBADF, errno.ENOTTY}
+
+HARDLINK_FALLBACK_ERRNOS = {
+    errno.EXDEV, errno.EPERM, errno.EACCES, errno.EMLINK,
+    getattr(errno, 'ENOTSUP', errno.EOPNOTSUPP), errno.EOPNOTSUPP,
+}
+
+# Minimum number of seconds between progress reports of throttle_progress
+PROGRESS_INTERVAL = 1
+
+
+def throttle_progress(callback, interval=PROGRESS_INTERVAL):
+    """
+    Returns a wrapper of the progress ``callback``, called with the amount
+    done and the total, that only calls it once the progress has increased
+    by at least a percent and ``interval`` seconds have passed since the
+    last call, and when done. Reporting progress usually means a write to
+    the database or result backend.
+    """
+
+    last = {'percent': -1, 'time': None}
+
+    def throttled(done, total):
+        percent = done * 100 // total if total else 100
+        now = time.monotonic()
+        if done < total:
+            if percent <= last['percent']:
+                return
+            if last['time'] is not None and now - last['time'] < interval:
+                return
+
+        last['percent'], last['time'] = percent, now
+        callback(done, total)
+
+    return throttled
+
+
+def _copy_file_range(in_fd, out_fd, count, block_size):
+    copied = 0
+    while copied < count:
+        try:
+            n = os.copy_file_range(in_fd, out_fd, min(count - copied, MAX_ZERO_COPY_SIZE))
+        except OSError as e:
+            if e.errno in ZERO_COPY_FALLBACK_ERRNOS:
+                break
+            raise
+
+        if n == 0:
+            break
+        copied += n
+
+    return copied
+
+
+def _sendfile(in_fd, out_fd, count, block_size):
+    copied = 0
+    while copied < count:
+        try:
+            n = os.sendfile(out_fd, in_fd, None, min(count - copied, MAX_ZERO_COPY_SIZE))
+        except OSError as e:
+            if e.errno in ZERO_COPY_FALLBACK_ERRNOS:
+                break
+            raise
+
+        if n == 0:
+            break
+        copied += n
+
+    return copied
+
+
+def _buffered_copy(in_fd, out_fd, count, block_size, hashers=()):
+    copied = 0
+    while copied < count:
+        buf = os.read(in_fd, min(count - copied, block_size))
+        if not buf:
+            break
+
+        for hasher in hashers:
+            hasher.update(buf)
+
+        view = memoryview(buf)
+        while view:
+            written = os.write(out_fd, view)
+            view = view[written:]
+        copied += len(buf)
+
+    return copied
+
+
+def _get_copy_methods():
+    methods = []
+    if hasattr(os, 'copy_file_range'):
+        methods.append(_copy_file_range)
+    if hasattr(os, 'sendfile'):
+        methods.append(_sendfile)
+    methods.append(_buffered_copy)
+    return methods
+
+
+def copy_fd(in_fd, out_fd, count, block_size=DEFAULT_BLOCK_SIZE, hashers=None, used_methods=None):
+    """
+    Copies ``count`` bytes from the current offset of ``in_fd`` to the current
+    offset of ``out_fd`` and advances both offsets.
+
+    The data is copied inside the kernel using ``os.copy_file_range`` or
+    ``os.sendfile`` when possible, falling back to a buffered copy using
+    ``block_size`` sized blocks when neither is supported.
+
+    ``out_fd`` must not be opened with ``O_APPEND``.
+
+    Args:
+        hashers: hashlib objects that are updated with the copied data, this
+            forces a buffered copy
+        used_methods: A set that the names of the methods that copied any
+            data are added to
+
+    Returns:
+        The number of bytes copied, less than ``count`` if ``in_fd`` reached
+        end of file first
+    """
+
+    if hashers:
+        return _buffered_copy(in_fd, out_fd, count, block_size, hashers=hashers)
+
+    copied = 0
+    for method in _get_copy_methods():
+        n = method(in_fd, out_fd, count - copied, block_size)
+        copied += n
+        if n and used_methods is not None:
+            used_methods.add(method.__name__.lstrip('_'))
+        if copied >= count:
+            break
+
+    return copied
+
+
+def append_file(src, out_fd, block_size=DEFAULT_BLOCK_SIZE, hashers=None):
+    """
+    Appends the content of ``src`` at the current offset of ``out_fd``
+
+    Returns:
+        The number of bytes appended
+    """
+
+    in_fd = os.open(src, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+    try:
+        return copy_fd(in_fd, out_fd, os.fstat(in_fd).st_size, block_size=block_size, hashers=hashers)
+    finally:
+        os.close(in_fd)
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+def _unlink_same_file(src, dst):
+    """
+    Removes ``dst`` if it is a hard link to ``src``, e.g. left by an earlier
+    copy with ``allow_hardlink``, since opening it for writing would
+    truncate ``src``
+    """
+
+    try:
+        same = os.path.samefile(src, dst)
+    except OSError:
+        return
+    if same:
+        _remove(dst)
+
+
+def link_file(src, dst):
+    """
+    Replaces ``dst`` with a hard link to ``src`` if they are on the same
+    filesystem
+
+    Returns:
+        True if the link was created
+    """
+
+    dst_dir = os.path.dirname(os.path.abspath(dst))
+    if os.stat(src).st_dev != os.stat(dst_dir).st_dev:
+        return False
+
+    _remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError as e:
+        if e.errno in HARDLINK_FALLBACK_ERRNOS:
+            return False
+        raise
+
+    return True
+
+
+def reflink_file(src, dst):
+    """
+    Replaces ``dst`` with a copy-on-write clone of ``src`` if supported by
+    the platform and filesystem
+
+    Returns:
+        True if the clone was created
+    """
+
+    if fcntl is None:
+        return False
+
+    _unlink_same_file(src, dst)
+    in_fd = os.open(src, os.O_RDONLY)
+    try:
+        out_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+        try:
+            fcntl.ioctl(out_fd, FICLONE, in_fd)
+        except OSError as e:
+            if e.errno in REFLINK_FALLBACK_ERRNOS:
+                return False
+            raise
+        finally:
+            os.close(out_fd)
+    finally:
+        os.close(in_fd)
+
+    return True
+
+
+class TransferCheckpoint:
+    """
+    The progress of copying ``src`` to ``dst``, stored next to ``src`` so
+    that an interrupted copy can be resumed by another process.
+
+    A checkpoint is only valid for the same destination and as long as the
+    size and modification time of ``src`` stay the same.
+    """
+
+    def __init__(self, src, dst):
+        self.src = src
+        self.dst = dst
+        dirname, basename = os.path.split(src)
+        self.path = os.path.join(dirname, '.%s.transfer' % basename)
+
+    def _get_src_stat(self):
+        st = os.stat(self.src)
+        return {'size': st.st_size, 'mtime': st.st_mtime_ns}
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+        if data.get('dst') != self.dst or data.get('src') != self._get_src_stat():
+            return {}
+
+        return data
+
+    def save(self, offset, **kwargs):
+        data = {'dst': self.dst, 'src': self._get_src_stat(), 'offset': offset}
+        data.update(kwargs)
+
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp, self.path)
+
+    def clear(self):
+        _remove(self.path)
+
+
+def copy_file_locally(src, dst, block_size=DEFAULT_BLOCK_SIZE, progress_callback=None, allow_hardlink=False):
+    """
+    Copies ``src`` to ``dst`` using the cheapest strategy available:
+
+    1. A hard link, if ``allow_hardlink`` is set and both are on the same
+       filesystem
+    2. A reflink, on filesystems supporting it
+    3. A copy inside the kernel when possible, else in blocks of
+       ``block_size`` bytes, with a checkpoint saved every
+       ``CHECKPOINT_SIZE`` bytes. An interrupted copy is resumed from the
+       last checkpoint.
+
+    Returns:
+        The strategy used
+    """
+
+    _unlink_same_file(src, dst)
+
+    checkpoint = TransferCheckpoint(src, dst)
+    offset = checkpoint.load().get('offset', 0)
+
+    # the checkpoint is only valid if dst still has everything before it,
+    # else resuming would leave a zero-filled gap
+    if offset and not (os.path.isfile(dst) and os.path.getsize(dst) >= offset):
+        logger.info('{} is missing data before the checkpoint, copying from the start'.format(dst))
+        checkpoint.clear()
+        offset = 0
+
+    if offset:
+        logger.info('Resuming copy of {} to {} at offset {}'.format(src, dst, offset))
+    else:
+        strategy = None
+        if allow_hardlink and link_file(src, dst):
+            strategy = 'hardlink'
+        elif reflink_file(src, dst):
+            strategy = 'reflink'
+
+        if strategy is not None:
+            logger.info('Copied {} to {} using {}'.format(src, dst, strategy))
+            checkpoint.clear()
+            if progress_callback is not None:
+                size = os.path.getsize(src)
+                progress_callback(size, size)
+            return strategy
+
+    used_methods = set()
+    in_fd = os.open(src, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+    try:
+        size = os.fstat(in_fd).st_size
+        out_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | getattr(os, 'O_BINARY', 0))
+        try:
+            # anything after the checkpoint might be incomplete
+            os.ftruncate(out_fd, offset)
+            os.lseek(in_fd, offset, os.SEEK_SET)
+            os.lseek(out_fd, offset, os.SEEK_SET)
+
+            while offset < size:
+                copied = copy_fd(
+                    in_fd, out_fd, min(max(block_size, CHECKPOINT_SIZE), size - offset),
+                    block_size=block_size, used_methods=used_methods,
+                )
+                if copied == 0:
+                    break
+
+                offset += copied
+                checkpoint.save(offset)
+
+                if progress_callback is not None:
+                    progress_callback(offset, size)
+        finally:
+            os.close(out_fd)
+    finally:
+        os.close(in_fd)
+
+    checkpoint.clear()
+
+    strategy = ', '.join(sorted(used_methods)) or 'copy'
+    logger.info('Copied {} to {} using {}'.format(src, dst, strategy))
+    return strategy
+
+
+def _get_expected_offset(response):
+    try:
+        return int(response.json()['offset'])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+@retry(retry=retry_if_exception_type((ConnectionError, Timeout)), reraise=True, stop=stop_after_attempt(5),
+       wait=wait_fixed(60), before_sleep=before_sleep_log(logger, logging.DEBUG))
+def _send_chunk(requests_session, dst, filename, chunk, offset, size, upload_id):
+    # an empty range can't be expressed, an empty file is sent without one
+    headers = {}
+    if chunk:
+        headers['Content-Range'] = 'bytes %s-%s/%s' % (offset, offset + len(chunk) - 1, size)
+    data = {'upload_id': upload_id}
+    files = {'the_file': (filename, chunk)}
+    return requests_session.post(dst, files=files, data=data, headers=headers, timeout=60)
+
+
+@retry(retry=retry_if_exception_type((ConnectionError, Timeout)), reraise=True, stop=stop_after_attempt(5),
+       wait=wait_fixed(60), before_sleep=before_sleep_log(logger, logging.DEBUG))
+def _send_completion_request(requests_session, dst, data):
+    completion_url = dst.rstrip('/') + '_complete/'
+    return requests_session.post(completion_url, data=data, timeout=60)
+
+
+def _is_already_complete(response):
+    try:
+        detail = str(response.json()['detail']).lower()
+    except (KeyError, TypeError, ValueError):
+        return False
+    return 'already' in detail and 'complete' in detail
+
+
+def copy_file_remotely(src, dst, requests_session, block_size=DEFAULT_BLOCK_SIZE, progress_callback=None):
+    """
+    Uploads ``src`` in chunks of ``block_size`` bytes to the chunked upload
+    endpoint ``dst``, saving the upload id and offset after each chunk.
+
+    An interrupted upload is resumed from the last checkpoint. If the
+    receiver got chunks after the checkpoint was saved, the upload continues
+    from the offset it reports instead.
+    """
+
+    filename = os.path.basename(src)
+    checkpoint = TransferCheckpoint(src, dst)
+    state = checkpoint.load()
+    upload_id = state.get('upload_id')
+    offset = state.get('offset', 0) if upload_id else 0
+    resumed = upload_id is not None
+
+    if resumed:
+        logger.info('Resuming upload of {} to {} at offset {}'.format(src, dst, offset))
+
+    with open(src, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+
+        # a resumed upload might already have everything, a new upload needs
+        # at least one chunk, even if empty, to get an upload id
+        while upload_id is None or offset < size:
+            f.seek(offset)
+            chunk = f.read(block_size)
+            response = _send_chunk(requests_session, dst, filename, chunk, offset, size, upload_id)
+
+            if response.status_code == 400 and upload_id is not None:
+                expected_offset = _get_expected_offset(response)
+                if expected_offset is not None and expected_offset != offset:
+                    logger.info('Receiver expects offset {} of {}, continuing from there'.format(
+                        expected_offset, src
+                    ))
+                    offset = expected_offset
+                    checkpoint.save(offset, upload_id=upload_id)
+                    continue
+
+            if response.status_code in (404, 410) and resumed:
+                # the receiver no longer knows about the upload we resumed
+                logger.info('Upload {} of {} is gone, starting over'.format(upload_id, src))
+                upload_id, offset, resumed = None, 0, False
+                checkpoint.clear()
+                continue
+
+            response.raise_for_status()
+            upload_id = response.json().get('upload_id', upload_id)
+            offset += len(chunk)
+            checkpoint.save(offset, upload_id=upload_id)
+
+            if progress_callback is not None:
+                progress_callback(offset, size)
+
+    md5 = calculate_checksum(src, algorithm='MD5', block_size=block_size)
+    response = _send_completion_request(requests_session, dst, {'path': filename, 'upload_id': upload_id, 'md5': md5})
+
+    if response.status_code == 400 and _is_already_complete(response):
+        # a previous attempt completed the upload but died before clearing
+        # the checkpoint
+        logger.info('Upload {} of {} is already complete'.format(upload_id, src))
+    else:
+        if 400 <= response.status_code < 500:
+            # the receiver rejected the upload, start over on the next
+            # attempt instead of completing it again
+            checkpoint.clear()
+        response.raise_for_status()
+
+    checkpoint.clear()
+
+
+def copy_file(src, dst, requests_session=None, block_size=DEFAULT_BLOCK_SIZE, progress_callback=None,
+              allow_hardlink=False):
+    """
+    Copies ``src`` to ``dst``, a local path or, if ``requests_session`` is
+    given, the url of a chunked upload endpoint. Interrupted copies are
+    resumed.
+    """
+
+    if requests_session is not None:
+        return copy_file_remotely(src, dst, requests_session, block_size=block_size,
+                                  progress_callback=progress_callback)
+
+    return copy_file_locally(src, dst, block_size=block_size, progress_callback=progress_callback,
+                             allow_hardlink=allow_hardlink)
+
+
+def _scan_tree(src, dst, symlinks=False):
+    """
+    Creates the directories of ``src`` in ``dst`` and returns the files to
+    copy as ``(src, dst)`` tuples along with the directories created
+    """
+
+    files = []
+    dirs = []
+    stack = [(src, dst)]
+
+    while stack:
+        src_dir, dst_dir = stack.pop()
+        os.makedirs(dst_dir, exist_ok=True)
+        dirs.append((src_dir, dst_dir))
+
+        with os.scandir(src_dir) as it:
+            for entry in it:
+                entry_dst = os.path.join(dst_dir, entry.name)
+
+                if symlinks and entry.is_symlink():
+                    os.symlink(os.readlink(entry.path), entry_dst)
+                elif entry.is_dir():
+                    stack.append((entry.path, entry_dst))
+                else:
+                    files.append((entry.path, entry_dst))
+
+    return files, dirs
+
+
+def _copy_tree_file(src, dst, block_size):
+    size = os.stat(src).st_size
+
+    if not reflink_file(src, dst):
+        _unlink_same_file(src, dst)
+        in_fd = os.open(src, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+        try:
+            out_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0))
+            try:
+                copy_fd(in_fd, out_fd, size, block_size=block_size)
+            finally:
+                os.close(out_fd)
+        finally:
+            os.close(in_fd)
+
+    copied = os.stat(dst).st_size
+    if copied != size:
+        raise OSError(errno.EIO, 'Copied {} of {} bytes'.format(copied, size), src)
+
+    shutil.copystat(src, dst)
+    return size
+
+
+def _copy_files(files, workers, block_size, progress_callback):
+    """
+    Copies the ``(src, dst)`` tuples in ``files`` concurrently
+
+    Returns:
+        The number of bytes copied and the errors as ``(src, dst, reason)``
+        tuples
+    """
+
+    total = len(files)
+    copied = 0
+    errors = []
+    done = 0
+    files = iter(files)
+
+    if progress_callback is not None:
+        progress_callback = throttle_progress(progress_callback)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # only keep a bounded number of files queued to avoid creating a
+        # future for every file in large trees up front
+        pending = {}
+        while True:
+            for file_src, file_dst in files:
+                pending[executor.submit(_copy_tree_file, file_src, file_dst, block_size)] = (file_src, file_dst)
+                if len(pending) >= workers * 2:
+                    break
+
+            if not pending:
+                break
+
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                file_src, file_dst = pending.pop(future)
+                try:
+                    copied += future.result()
+                except OSError as e:
+                    errors.append((file_src, file_dst, str(e)))
+
+                done += 1
+                if progress_callback is not None:
+                    progress_callback(done, total)
+
+    return copied, errors
+
+
+def _copy_dir_stats(dirs, errors):
+    # set directory times last since copying files into them updates them
+    for dir_src, dir_dst in reversed(dirs):
+        try:
+            shutil.copystat(dir_src, dir_dst)
+        except OSError as e:
+            errors.append((dir_src, dir_dst, str(e)))
+
+
+def copy_tree(src, dst, symlinks=False, workers=None, block_size=DEFAULT_BLOCK_SIZE, progress_callback=None):
+    """
+    Recursively copies the directory ``src`` to ``dst``, which must not
+    exist, like ``shutil.copytree``. The files are copied concurrently using
+    ``workers`` threads, as reflinks if supported by the filesystem and
+    otherwise using the methods of ``copy_fd``. The size of each copy is
+    verified.
+
+    Args:
+        symlinks: Copy symbolic links as links instead of the files they
+            point to
+        progress_callback: Called with the number of files copied so far and
+            the total number of files, see ``throttle_progress``
+
+    Returns:
+        The number of bytes copied
+
+    Raises:
+        shutil.Error: One or more files could not be copied, ``dst`` is
+            removed
+    """
+
+    os.makedirs(dst)
+    try:
+        return _copy_tree(src, dst, symlinks, workers, block_size, progress_callback)
+    except BaseException:
+        shutil.rmtree(dst, ignore_errors=True)
+        raise
+
+
+def _copy_tree(src, dst, symlinks, workers, block_size, progress_callback):
+    files, dirs = _scan_tree(src, dst, symlinks=symlinks)
+    workers = workers or DEFAULT_TREE_COPY_WORKERS
+    logger.debug('Copying {} files from {} to {} using {} workers'.format(len(files), src, dst, workers))
+
+    copied, errors = _copy_files(files, workers, block_size, progress_callback)
+    _copy_dir_stats(dirs, errors)
+    if errors:
+        raise shutil.Error(errors)
+
+    logger.info('Copied {} files ({} bytes) from {} to {}'.format(len(files), copied, src, dst))
+    return copied
+
+
+def _remove_path(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    else:
+        os.remove(path)
+
+
+def _copy_into(to_copy, workers, block_size, progress_callback):
+    """
+    Copies the ``(src, dst)`` tuples in ``to_copy`` for ``move_into``, the
+    copies are removed if any of them fails
+
+    Returns:
+        The number of files and bytes copied
+    """
+
+    files = []
+    dirs = []
+    try:
+        for src, dst in to_copy:
+            if os.path.islink(src):
+                os.symlink(os.readlink(src), dst)
+            elif os.path.isdir(src):
+                tree_files, tree_dirs = _scan_tree(src, dst, symlinks=True)
+                files.extend(tree_files)
+                dirs.extend(tree_dirs)
+            else:
+                files.append((src, dst))
+
+        workers = workers or DEFAULT_TREE_COPY_WORKERS
+        copied, errors = _copy_files(files, workers, block_size, progress_callback)
+        _copy_dir_stats(dirs, errors)
+        if errors:
+            raise shutil.Error(errors)
+    except BaseException:
+        for _, dst in to_copy:
+            if os.path.lexists(dst):
+                _remove_path(dst)
+        raise
+
+    return len(files), copied
+
+
+def move_into(srcs, dst_dir, workers=None, block_size=DEFAULT_BLOCK_SIZE, progress_callback=None):
+    """
+    Moves each path in ``srcs`` into the directory ``dst_dir``, like
+    ``shutil.move``. ``dst_dir`` is created if it doesn't exist.
+
+    Paths on the same filesystem as ``dst_dir`` are renamed. The others are
+    copied concurrently with ``workers`` threads, verified and then removed.
+    If anything fails, the copies are removed, the renamed paths are renamed
+    back and the sources are kept.
+
+    Args:
+        progress_callback: Called with the number of files copied so far and
+            the total number of files to copy, see ``throttle_progress``
+
+    Returns:
+        The number of bytes copied, renamed paths count as 0
+
+    Raises:
+        shutil.Error: A destination path already exists or one or more files
+            could not be copied
+    """
+
+    os.makedirs(dst_dir, exist_ok=True)
+    dst_dev = os.stat(dst_dir).st_dev
+    moves = []
+    for src in srcs:
+        dst = os.path.join(dst_dir, os.path.basename(src.rstrip(os.sep)))
+        if os.path.lexists(dst):
+            raise shutil.Error("Destination path '{}' already exists".format(dst))
+        moves.append((src, dst))
+
+    renamed = []
+    to_copy = []
+    try:
+        for src, dst in moves:
+            if os.lstat(src).st_dev == dst_dev:
+                try:
+                    os.rename(src, dst)
+                    renamed.append((src, dst))
+                    continue
+                except OSError as e:
+                    if e.errno != errno.EXDEV:
+                        raise
+            to_copy.append((src, dst))
+
+        if not to_copy:
+            logger.debug('Renamed {} paths into {}'.format(len(moves), dst_dir))
+            return 0
+
+        file_count, copied = _copy_into(to_copy, workers, block_size, progress_callback)
+    except BaseException:
+        for src, dst in reversed(renamed):
+            try:
+                os.rename(dst, src)
+            except OSError:
+                logger.exception('Could not move {} back to {}'.format(dst, src))
+        raise
+
+    for src, _ in to_copy:
+        _remove_path(src)
+
+    logger.info('Moved {} paths into {}, copied {} files ({} bytes) across filesystems'.format(
+        len(moves), dst_dir, file_count, copied,
+    ))
+    return copied
@@ -0,0 +1,56 @@
+import gzip
+import io
+import os
+import zlib
+
+from django.test import SimpleTestCase
+
+from storage.compression import ParallelGzipWriter
+
+
+class ParallelGzipWriterTests(SimpleTestCase):
+    def compress(self, data, chunk_size=1000, **kwargs):
+        out = io.BytesIO()
+        writer = ParallelGzipWriter(out, **kwargs)
+        for i in range(0, len(data), chunk_size):
+            writer.write(data[i:i + chunk_size])
+        writer.close()
+        return out.getvalue()
+
+    def count_members(self, compressed):
+        count = 0
+        while compressed:
+            decompressor = zlib.decompressobj(wbits=31)
+            decompressor.decompress(compressed)
+            compressed = decompressor.unused_data
+            count += 1
+        return count
+
+    def test_round_trip(self):
+        data = os.urandom(5000) + b'foo' * 10000
+        compressed = self.compress(data, block_size=4096, threads=4)
+
+        self.assertEqual(gzip.decompress(compressed), data)
+        self.assertEqual(self.count_members(compressed), 9)
+
+    def test_single_block(self):
+        compressed = self.compress(b'foo' * 100, threads=2)
+        self.assertEqual(gzip.decompress(compressed), b'foo' * 100)
+        self.assertEqual(self.count_members(compressed), 1)
+
+    def test_empty(self):
+        compressed = self.compress(b'')
+        self.assertEqual(gzip.decompress(compressed), b'')
+
+    def test_level(self):
+        data = b'foo bar baz ' * 10000
+        self.assertLess(len(self.compress(data, level=9)), len(self.compress(data, level=0)))
+
+    def test_abort_writes_nothing(self):
+        out = io.BytesIO()
+        writer = ParallelGzipWriter(out, block_size=10)
+        writer.write(b'foo')
+        writer.abort()
+
+        self.assertTrue(writer.closed)
+        self.assertEqual(out.getvalue(), b'')
@@ -0,0 +1,88 @@
+import hashlib
+import os
+import shutil
+import tarfile
+import tempfile
+import zipfile
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from storage.container import write_container
+
+
+class WriteContainerTests(SimpleTestCase):
+    def setUp(self):
+        self.datadir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.datadir)
+
+        self.src = os.path.join(self.datadir, 'ip')
+        os.makedirs(os.path.join(self.src, 'content', 'empty'))
+        self.files = {
+            'mets.xml': b'<mets/>',
+            os.path.join('content', 'foo.txt'): os.urandom(1024),
+        }
+        for name, content in self.files.items():
+            with open(os.path.join(self.src, name), 'wb') as f:
+                f.write(content)
+
+    def write(self, container_format, **kwargs):
+        dst = os.path.join(self.datadir, 'ip.%s' % container_format)
+        with mock.patch('storage.container.cache_checksum') as mock_cache:
+            checksums = write_container(self.src, dst, container_format, **kwargs)
+        return dst, checksums, mock_cache
+
+    def test_tar(self):
+        dst, _, _ = self.write('tar', arcname='objid')
+
+        with tarfile.open(dst) as tar:
+            self.assertCountEqual(tar.getnames(), [
+                'objid', 'objid/mets.xml', 'objid/content', 'objid/content/empty', 'objid/content/foo.txt',
+            ])
+            self.assertEqual(tar.extractfile('objid/content/foo.txt').read(), self.files['content/foo.txt'])
+
+    def test_zip(self):
+        dst, _, _ = self.write('zip')
+
+        with zipfile.ZipFile(dst) as zf:
+            self.assertIsNone(zf.testzip())
+            self.assertIn('ip/content/empty/', zf.namelist())
+            self.assertEqual(zf.read('ip/mets.xml'), self.files['mets.xml'])
+
+    def test_gzipped_tar(self):
+        dst, _, _ = self.write('tar.gz', compression_threads=2, compression_level=1)
+
+        with tarfile.open(dst, 'r:gz') as tar:
+            self.assertEqual(tar.extractfile('ip/content/foo.txt').read(), self.files['content/foo.txt'])
+
+    def test_checksums_recorded(self):
+        for container_format in ['tar', 'tar.gz', 'zip']:
+            with self.subTest(container_format=container_format):
+                dst, checksums, mock_cache = self.write(container_format, algorithms=['SHA-256', 'md5'])
+
+                with open(dst, 'rb') as f:
+                    content = f.read()
+                expected = {'SHA256': hashlib.sha256(content).hexdigest(), 'MD5': hashlib.md5(content).hexdigest()}
+                self.assertEqual(checksums, expected)
+                mock_cache.assert_has_calls([mock.call(dst, k, v) for k, v in expected.items()], any_order=True)
+
+    def test_progress(self):
+        callback = mock.Mock()
+        self.write('tar', progress_callback=callback, block_size=100)
+
+        total = sum(len(content) for content in self.files.values())
+        callback.assert_called_with(total, total)
+        # throttled, the first and the last of the reads are reported
+        self.assertEqual(callback.call_count, 2)
+
+    def test_failure_leaves_no_container(self):
+        dst = os.path.join(self.datadir, 'ip.tar')
+        with mock.patch('storage.container._add_to_tar', side_effect=OSError):
+            with self.assertRaises(OSError):
+                write_container(self.src, dst, 'tar')
+
+        self.assertEqual(sorted(os.listdir(self.datadir)), ['ip'])
+
+    def test_unsupported_format(self):
+        with self.assertRaises(ValueError):
+            write_container(self.src, os.path.join(self.datadir, 'ip.rar'), 'rar')
@@ -0,0 +1,474 @@
+import errno
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+from django.test import SimpleTestCase
+from requests.exceptions import HTTPError
+
+from storage.copy import (
+    TransferCheckpoint, _buffered_copy, append_file, copy_fd,
+    copy_file_locally, copy_file_remotely, copy_tree, link_file, move_into,
+    reflink_file, throttle_progress,
+)
+
+
+class CopyFdTests(SimpleTestCase):
+    def setUp(self):
+        self.datadir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.datadir)
+
+        self.src = os.path.join(self.datadir, 'src')
+        self.dst = os.path.join(self.datadir, 'dst')
+        self.content = os.urandom(1024)
+
+        with open(self.src, 'wb') as f:
+            f.write(self.content)
+
+    def copy(self, count, block_size=100):
+        in_fd = os.open(self.src, os.O_RDONLY)
+        out_fd = os.open(self.dst, os.O_WRONLY | os.O_CREAT)
+        try:
+            return copy_fd(in_fd, out_fd, count, block_size=block_size)
+        finally:
+            os.close(in_fd)
+            os.close(out_fd)
+
+    def test_copy(self):
+        self.assertEqual(self.copy(len(self.content)), len(self.content))
+
+        with open(self.dst, 'rb') as f:
+            self.assertEqual(f.read(), self.content)
+
+    def test_copy_past_end_of_file(self):
+        self.assertEqual(self.copy(len(self.content) * 2), len(self.content))
+
+    @mock.patch('storage.copy._get_copy_methods')
+    def test_buffered_fallback(self, mock_methods):
+        mock_methods.return_value = [_buffered_copy]
+
+        self.assertEqual(self.copy(len(self.content)), len(self.content))
+
+        with open(self.dst, 'rb') as f:
+            self.assertEqual(f.read(), self.content)
+
+    def test_append_file(self):
+        out_fd = os.open(self.dst, os.O_WRONLY | os.O_CREAT)
+        try:
+            append_file(self.src, out_fd)
+            append_file(self.src, out_fd)
+        finally:
+            os.close(out_fd)
+
+        with open(self.dst, 'rb') as f:
+            self.assertEqual(f.read(), self.content * 2)
+
+
+class CopyFileLocallyTests(SimpleTestCase):
+    def setUp(self):
+        self.datadir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.datadir)
+
+        self.src = os.path.join(self.datadir, 'src')
+        self.dst = os.path.join(self.datadir, 'dst')
+        self.content = os.urandom(1000)
+
+        with open(self.src, 'wb') as f:
+            f.write(self.content)
+
+    @mock.patch('storage.copy.CHECKPOINT_SIZE', 400)
+    @mock.patch('storage.copy.reflink_file', return_value=False)
+    def test_copy(self, mock_reflink):
+        progress = mock.Mock()
+        self.assertNotIn('link', copy_file_locally(self.src, self.dst, block_size=400, progress_callback=progress))
+
+        with open(self.dst, 'rb') as f:
+            self.assertEqual(f.read(), self.content)
+
+        progress.assert_has_calls([mock.call(400, 1000), mock.call(800, 1000), mock.call(1000, 1000)])
+        self.assertEqual(TransferCheckpoint(self.src, self.dst).load(), {})
+
+    @mock.patch('storage.copy.os.fsync')
+    @mock.patch('storage.copy.copy_fd', wraps=copy_fd)
+    @mock.patch('storage.copy.reflink_file', return_value=False)
+    def test_copy_in_single_span(self, mock_reflink, mock_copy_fd, mock_fsync):
+        copy_file_locally(self.src, self.dst, block_size=400)
+
+        mock_copy_fd.assert_called_once_with(mock.ANY, mock.ANY, 1000, block_size=400, used_methods=mock.ANY)
+        mock_fsync.assert_not_called()
+        with open(self.dst, 'rb') as f:
+            self.assertEqual(f.read(), self.content)
+
+    @mock.patch('storage.copy.reflink_file', return_value=False)
+    def test_checkpoint_without_dst(self, mock_reflink):
+        TransferCheckpoint(self.src, self.dst).save(400)
+        copy_file_locally(self.src, self.dst, block_size=400)
+
+        with open(self.dst, 'rb') as f:
+            self.assertEqual(f.read(), self.content)
+
+    @mock.patch('storage.copy.reflink_file', return_value=False)
+    def test_checkpoint_beyond_dst(self, mock_reflink):
+        with open(self.dst, 'wb') as f:
+            f.write(b'x' * 100)
+        TransferCheckpoint(self.src, self.dst).save(400)
+        copy_file_locally(self.src, self.dst, block_size=400)
+
+        with open(self.dst, 'rb') as f:
+            self.assertEqual(f.read(), self.content)
+
+    def test_copy_over_hardlink_to_src(self):
+        os.link(self.src, self.dst)
+
+        with mock.patch('storage.copy.reflink_file', return_value=False):
+            copy_file_locally(self.src, self.dst, block_size=400)
+        self.assertFalse(os.path.samefile(self.src, self.dst))
+
+        for path in [self.src, self.dst]:
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(), self.content)
+
+    def test_reflink_over_hardlink_to_src(self):
+        os.link(self.src, self.dst)
+
+        with mock.patch('storage.copy.fcntl') as mock_fcntl:
+            mock_fcntl.ioctl.side_effect = OSError(errno.EOPNOTSUPP, 'not supported')
+            self.assertFalse(reflink_file(self.src, self.dst))
+
+        with open(self.src, 'rb') as f:
+            self.assertEqual(f.read(), self.content)
+
+    @mock.patch('storage.copy.CHECKPOINT_SIZE', 400)
+    def test_resume_from_checkpoint(self):
+        # a previous attempt copied 400 bytes and then wrote garbage
+        with open(self.dst, 'wb') as f:
+            f.write(self.content[:400] + b'garbage')
+        TransferCheckpoint(self.src, self.dst).save(400)
+
+        progress = mock.Mock()
+        copy_file_locally(self.src, self.dst, block_size=400, progress_callback=progress)
+
+        with open(self.dst, 'rb') as f:
+            self.assertEqual(f.read(), self.content)
+
+        progress.assert_has_calls([mock.call(800, 1000), mock.call(1000, 1000)])
+
+    @mock.patch('storage.copy.reflink_file')
+    def test_hardlink(self, mock_reflink):
+        with open(self.dst, 'wb') as f:
+            f.write(b'stale')
+
+        progress = mock.Mock()
+        strategy = copy_file_locally(self.src, self.dst, progress_callback=progress, allow_hardlink=True)
+
+        self.assertEqual(strategy, 'hardlink')
+        self.assertTrue(os.path.samefile(self.src, self.dst))
+        progress.assert_called_once_with(1000, 1000)
+        mock_reflink.assert_not_called()
+
+    @mock.patch('storage.copy.os.link', side_effect=OSError(errno.EPERM, 'Operation not permitted'))
+    @mock.patch('storage.copy.reflink_file', return_value=False)
+    def test_hardlink_not_permitted(self, mock_reflink, mock_link):
+        copy_file_locally(self.src, self.dst, allow_hardlink=True)
+
+        self.assertFalse(os.path.samefile(self.src, self.dst))
+        with open(self.dst, 'rb') as f:
+            self.assertEqual(f.read(), self.content)
+
+    @mock.patch('storage.copy.os.link')
+    def test_hardlink_across_filesystems(self, mock_link):
+        real_stat = os.stat
+
+        def stat(path):
+            st = real_stat(path)
+            if path == self.src:
+                return mock.Mock(st_dev=st.st_dev + 1)
+            return st
+
+        with mock.patch('storage.copy.os.stat', side_effect=stat):
+            self.assertFalse(link_file(self.src, self.dst))
+        mock_link.assert_not_called()
+
+    @mock.patch('storage.copy.reflink_file', return_value=True)
+    def test_reflink(self, mock_reflink):
+        self.assertEqual(copy_file_locally(self.src, self.dst), 'reflink')
+        mock_reflink.assert_called_once_with(self.src, self.dst)
+
+    @mock.patch('storage.copy.reflink_file')
+    def test_no_fast_path_when_resuming(self, mock_reflink):
+        with open(self.dst, 'wb') as f:
+            f.write(self.content[:400])
+        TransferCheckpoint(self.src, self.dst).save(400)
+
+        copy_file_locally(self.src, self.dst, allow_hardlink=True)
+
+        mock_reflink.assert_not_called()
+        self.assertFalse(os.path.samefile(self.src, self.dst))
+
+    def test_ignore_checkpoint_for_other_destination(self):
+        TransferCheckpoint(self.src, 'other').save(400)
+        self.assertEqual(TransferCheckpoint(self.src, self.dst).load(), {})
+
+
+class CopyFileRemotelyTests(SimpleTestCase):
+    def setUp(self):
+        self.datadir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.datadir)
+
+        self.src = os.path.join(self.datadir, 'src')
+        self.dst = 'http://example.com/api/ip-reception/upload/'
+        self.content = os.urandom(1000)
+
+        with open(self.src, 'wb') as f:
+            f.write(self.content)
+
+        self.session = mock.Mock()
+
+    def get_response(self, status_code=200, data=None):
+        response = mock.Mock(status_code=status_code)
+        response.json.return_value = data if data is not None else {'upload_id': 'foo'}
+        return response
+
+    def get_sent_ranges(self):
+        return [
+            c[1]['headers']['Content-Range'] for c in self.session.post.call_args_list
+            if 'headers' in c[1]
+        ]
+
+    def test_upload(self):
+        self.session.post.return_value = self.get_response()
+        copy_file_remotely(self.src, self.dst, self.session, block_size=400)
+
+        self.assertEqual(self.get_sent_ranges(), ['bytes 0-399/1000', 'bytes 400-799/1000', 'bytes 800-999/1000'])
+        self.session.post.assert_called_with(
+            'http://example.com/api/ip-reception/upload_complete/', data=mock.ANY, timeout=60,
+        )
+        self.assertEqual(TransferCheckpoint(self.src, self.dst).load(), {})
+
+    def test_resume_from_checkpoint(self):
+        TransferCheckpoint(self.src, self.dst).save(400, upload_id='foo')
+        self.session.post.return_value = self.get_response()
+        copy_file_remotely(self.src, self.dst, self.session, block_size=400)
+
+        self.assertEqual(self.get_sent_ranges(), ['bytes 400-799/1000', 'bytes 800-999/1000'])
+
+    def test_resume_from_offset_of_receiver(self):
+        TransferCheckpoint(self.src, self.dst).save(400, upload_id='foo')
+        self.session.post.side_effect = [
+            self.get_response(400, {'offset': 800}),
+            self.get_response(),
+            self.get_response(),
+        ]
+        copy_file_remotely(self.src, self.dst, self.session, block_size=400)
+
+        self.assertEqual(self.get_sent_ranges(), ['bytes 400-799/1000', 'bytes 800-999/1000'])
+
+    def test_resume_after_last_chunk(self):
+        TransferCheckpoint(self.src, self.dst).save(1000, upload_id='foo')
+        self.session.post.return_value = self.get_response()
+        copy_file_remotely(self.src, self.dst, self.session, block_size=400)
+
+        self.session.post.assert_called_once_with(
+            'http://example.com/api/ip-reception/upload_complete/', data=mock.ANY, timeout=60,
+        )
+        self.assertEqual(TransferCheckpoint(self.src, self.dst).load(), {})
+
+    def test_resume_already_completed_upload(self):
+        TransferCheckpoint(self.src, self.dst).save(1000, upload_id='foo')
+        self.session.post.return_value = self.get_response(
+            400, {'detail': 'Upload has already been marked as complete'},
+        )
+        copy_file_remotely(self.src, self.dst, self.session, block_size=400)
+
+        self.assertEqual(TransferCheckpoint(self.src, self.dst).load(), {})
+
+    def test_rejected_completion_clears_checkpoint(self):
+        TransferCheckpoint(self.src, self.dst).save(1000, upload_id='foo')
+        response = self.get_response(400, {'detail': 'Invalid checksum'})
+        response.raise_for_status.side_effect = HTTPError
+        self.session.post.return_value = response
+
+        with self.assertRaises(HTTPError):
+            copy_file_remotely(self.src, self.dst, self.session, block_size=400)
+
+        self.assertEqual(TransferCheckpoint(self.src, self.dst).load(), {})
+
+    def test_upload_empty_file(self):
+        open(self.src, 'wb').close()
+        self.session.post.return_value = self.get_response()
+        copy_file_remotely(self.src, self.dst, self.session, block_size=400)
+
+        self.assertEqual(self.session.post.call_count, 2)
+        self.assertEqual(self.session.post.call_args_list[0][1]['headers'], {})
+
+
+class CopyTreeTests(SimpleTestCase):
+    def setUp(self):
+        self.datadir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.datadir)
+
+        self.src = os.path.join(self.datadir, 'src')
+        self.dst = os.path.join(self.datadir, 'dst')
+
+        self.files = {
+            'foo.txt': b'foo',
+            os.path.join('a', 'bar.txt'): b'bar',
+            os.path.join('a', 'b', 'baz.txt'): os.urandom(1000),
+        }
+        for name, content in self.files.items():
+            path = os.path.join(self.src, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(content)
+        os.makedirs(os.path.join(self.src, 'empty'))
+
+    def test_copy(self):
+        progress = mock.Mock()
+        copy_tree(self.src, self.dst, workers=2, block_size=100, progress_callback=progress)
+
+        for name, content in self.files.items():
+            with open(os.path.join(self.dst, name), 'rb') as f:
+                self.assertEqual(f.read(), content)
+        self.assertTrue(os.path.isdir(os.path.join(self.dst, 'empty')))
+
+        # the progress is throttled, the first and last files are reported
+        self.assertEqual(progress.call_count, 2)
+        progress.assert_called_with(3, 3)
+
+    def test_copy_preserves_times(self):
+        path = os.path.join(self.src, 'foo.txt')
+        os.utime(path, (1000000000, 1000000000))
+
+        copy_tree(self.src, self.dst)
+
+        self.assertEqual(os.stat(os.path.join(self.dst, 'foo.txt')).st_mtime, 1000000000)
+
+    def test_copy_symlinks(self):
+        os.symlink('foo.txt', os.path.join(self.src, 'link'))
+
+        copy_tree(self.src, self.dst, symlinks=True)
+        self.assertEqual(os.readlink(os.path.join(self.dst, 'link')), 'foo.txt')
+
+    def test_existing_destination(self):
+        os.makedirs(self.dst)
+        with self.assertRaises(FileExistsError):
+            copy_tree(self.src, self.dst)
+        self.assertTrue(os.path.isdir(self.dst))
+
+    @mock.patch('storage.copy.copy_fd', side_effect=OSError(errno.EIO, 'Input/output error'))
+    @mock.patch('storage.copy.reflink_file', return_value=False)
+    def test_failed_copy_removes_destination(self, mock_reflink, mock_copy_fd):
+        with self.assertRaises(shutil.Error) as cm:
+            copy_tree(self.src, self.dst)
+
+        self.assertEqual(len(cm.exception.args[0]), 3)
+        self.assertFalse(os.path.exists(self.dst))
+
+
+class MoveIntoTests(SimpleTestCase):
+    def setUp(self):
+        self.datadir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.datadir)
+
+        self.src = os.path.join(self.datadir, 'src')
+        self.dst = os.path.join(self.datadir, 'dst')
+        os.makedirs(os.path.join(self.src, 'dir', 'sub'))
+        os.makedirs(self.dst)
+
+        self.files = {
+            'file.txt': b'foo',
+            os.path.join('dir', 'sub', 'bar.txt'): os.urandom(1000),
+        }
+        for name, content in self.files.items():
+            with open(os.path.join(self.src, name), 'wb') as f:
+                f.write(content)
+
+        self.srcs = [os.path.join(self.src, 'file.txt'), os.path.join(self.src, 'dir')]
+
+    def assert_moved(self):
+        for name, content in self.files.items():
+            self.assertFalse(os.path.exists(os.path.join(self.src, name)))
+            with open(os.path.join(self.dst, name), 'rb') as f:
+                self.assertEqual(f.read(), content)
+
+    def test_rename_on_same_filesystem(self):
+        with mock.patch('storage.copy._copy_files') as mock_copy:
+            self.assertEqual(move_into(self.srcs, self.dst), 0)
+
+        mock_copy.assert_not_called()
+        self.assert_moved()
+
+    @mock.patch('storage.copy.os.rename', side_effect=OSError(errno.EXDEV, 'Invalid cross-device link'))
+    def test_copy_across_filesystems(self, mock_rename):
+        progress = mock.Mock()
+        self.assertEqual(move_into(self.srcs, self.dst, workers=2, progress_callback=progress), 1003)
+
+        self.assert_moved()
+        progress.assert_called_with(2, 2)
+
+    @mock.patch('storage.copy.reflink_file', return_value=False)
+    @mock.patch('storage.copy.copy_fd', return_value=0)
+    @mock.patch('storage.copy.os.rename', side_effect=OSError(errno.EXDEV, 'Invalid cross-device link'))
+    def test_failed_copy_keeps_source(self, mock_rename, mock_copy_fd, mock_reflink):
+        with self.assertRaises(shutil.Error):
+            move_into(self.srcs, self.dst)
+
+        self.assertEqual(os.listdir(self.dst), [])
+        for name in self.files:
+            self.assertTrue(os.path.isfile(os.path.join(self.src, name)))
+
+    def test_missing_destination(self):
+        dst = os.path.join(self.dst, 'content')
+
+        self.assertEqual(move_into(self.srcs, dst), 0)
+
+        for name, content in self.files.items():
+            with open(os.path.join(dst, name), 'rb') as f:
+                self.assertEqual(f.read(), content)
+
+    @mock.patch('storage.copy.reflink_file', return_value=False)
+    @mock.patch('storage.copy.copy_fd', return_value=0)
+    def test_failed_copy_moves_renamed_back(self, mock_copy_fd, mock_reflink):
+        rename = os.rename
+
+        def rename_only_file(src, dst):
+            if os.path.basename(src) != 'file.txt':
+                raise OSError(errno.EXDEV, 'Invalid cross-device link')
+            rename(src, dst)
+
+        with mock.patch('storage.copy.os.rename', side_effect=rename_only_file):
+            with self.assertRaises(shutil.Error):
+                move_into(self.srcs, self.dst)
+
+        self.assertEqual(os.listdir(self.dst), [])
+        for name in self.files:
+            self.assertTrue(os.path.isfile(os.path.join(self.src, name)))
+
+    def test_existing_destination(self):
+        open(os.path.join(self.dst, 'file.txt'), 'w').close()
+
+        with self.assertRaises(shutil.Error):
+            move_into(self.srcs, self.dst)
+
+        self.assertTrue(os.path.isdir(os.path.join(self.src, 'dir')))
+
+
+class ThrottleProgressTests(SimpleTestCase):
+    @mock.patch('storage.copy.time.monotonic')
+    def test_throttled(self, mock_time):
+        callback = mock.Mock()
+        throttled = throttle_progress(callback, interval=1)
+
+        for now, done in [(0, 1), (0.5, 50), (2, 1005), (2, 1009), (5, 1020), (5, 2000)]:
+            mock_time.return_value = now
+            throttled(done, 2000)
+
+        self.assertEqual(callback.call_args_list, [
+            mock.call(1, 2000), mock.call(1005, 2000), mock.call(1020, 2000), mock.call(2000, 2000),
+        ])
+
+    def test_no_total(self):
+        callback = mock.Mock()
+        throttle_progress(callback)(0, 0)
+        callback.assert_called_once_with(0, 0)
@@ -1,68 +1,343 @@
 # -*- coding: utf-8 -*-
 
 import errno
+import itertools
 import logging
 import os
 import shutil
 
+from celery import states as celery_states
 from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
 
+from ESSArch_Core.WorkflowEngine.models import ProcessTask
 from ESSArch_Core.WorkflowEngine.polling.backends.base import BaseWorkflowPoller
 from ESSArch_Core.auth.models import Group, GroupMember
 from ESSArch_Core.ip.models import InformationPackage
 from ESSArch_Core.profiles.models import SubmissionAgreement
 from ESSArch_Core.profiles.utils import profile_types
-from ESSArch_Core.util import stable_path
+from workflow.polling.inotify import DirectoryWatcher
 
 logger = logging.getLogger('essarch.etp.workflow.polling.DirectoryWorkflowPoller')
 p_types = [p_type.lower().replace(' ', '_') for p_type in profile_types]
 proj = settings.PROJECT_SHORTNAME
 
+HANDLED_CACHE_KEY = 'etp_workflow_poller_handled:{}'
+FINGERPRINT_CACHE_KEY = 'etp_workflow_poller_fingerprint:{}'
+
+# Number of directories looked up or created per query
+QUERY_BATCH_SIZE = 500
+
+# Watchers and the directories waiting to be handled, by polled path. These
+# live as long as the worker process, which polls the same paths repeatedly.
+_watchers = {}
+_pending = {}
+
+
+def _get_handled_key(objid):
+    return HANDLED_CACHE_KEY.format(objid)
+
+
+def _set_handled(objids):
+    # expire so that a directory is handled again if its information package
+    # is deleted and the directory is delivered again
+    timeout = getattr(settings, 'WORKFLOW_POLLER_HANDLED_TIMEOUT', 24 * 60 * 60)
+    cache.set_many({_get_handled_key(objid): True for objid in objids}, timeout=timeout)
+
+
+def _batches(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def get_fingerprint(path):
+    """
+    Returns the number of files, their total size and the latest
+    modification time of any file or directory in ``path``, from a single
+    walk of the tree
+    """
+
+    count = 0
+    size = 0
+    mtime = os.stat(path).st_mtime_ns
+    stack = [path]
+
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                st = entry.stat(follow_symlinks=False)
+                mtime = max(mtime, st.st_mtime_ns)
+
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                else:
+                    count += 1
+                    size += st.st_size
+
+    return count, size, mtime
+
+
+def stable_path(path):
+    """
+    Checks if ``path`` has stopped changing, i.e. if its fingerprint has
+    been unchanged for ``WORKFLOW_POLLER_STABLE_POLLS`` polls in a row
+    """
+
+    key = FINGERPRINT_CACHE_KEY.format(path)
+    fingerprint = get_fingerprint(path)
+    previous = cache.get(key)
+
+    unchanged = 0
+    if previous is not None and previous['fingerprint'] == fingerprint:
+        unchanged = previous['unchanged'] + 1
+
+    cache.set(key, {'fingerprint': fingerprint, 'unchanged': unchanged})
+    return unchanged >= getattr(settings, 'WORKFLOW_POLLER_STABLE_POLLS', 1)
+
+
+def get_poller_options(path, sa):
+    """
+    Returns the entry in ``ESSARCH_WORKFLOW_POLLERS`` polling ``path`` for
+    ``sa``, with the optional keys:
+
+        batch_size: The maximum number of information packages created
+            per poll
+        max_in_flight: The maximum number of information packages of the
+            SA being processed at once, no more are created while at or
+            above it
+    """
+
+    for options in getattr(settings, 'ESSARCH_WORKFLOW_POLLERS', {}).values():
+        if options.get('path') == path and options.get('sa') == sa:
+            return options
+
+    return {}
+
+
+def scan(path):
+    with os.scandir(path) as it:
+        return {entry.name for entry in it if entry.is_dir()}
+
+
+def _close_watcher(path):
+    watcher = _watchers.pop(path, None)
+    if watcher is not None:
+        watcher.close()
+    _pending.pop(path, None)
+
+
+def get_pending(path):
+    """
+    Returns the names of the directories in ``path`` that might not have been
+    handled yet.
+
+    With inotify available the directory is scanned the first time and after
+    that only directories created or moved in since then are added. Without
+    inotify, or if events have been lost, the directory is scanned.
+    """
+
+    if not getattr(settings, 'WORKFLOW_POLLER_INOTIFY', True):
+        return scan(path)
+
+    watcher = _watchers.get(path)
+    if watcher is not None:
+        changed, removed, rescan = watcher.read_events()
+        if not rescan:
+            pending = _pending[path]
+            pending.update(changed)
+            pending.difference_update(removed)
+
+            # a new directory with the name of a handled one has to be
+            # checked again
+            cache.delete_many([_get_handled_key(objid) for objid in changed])
+            return pending
+
+        logger.info(u'Lost inotify events for {}, scanning'.format(path))
+        _close_watcher(path)
+
+    try:
+        watcher = DirectoryWatcher(path)
+    except OSError as e:
+        logger.debug(u'Could not watch {} using inotify, scanning: {}'.format(path, e))
+        return scan(path)
+
+    # scan after the watch is added to not miss anything created in between
+    try:
+        pending = scan(path)
+    except OSError:
+        watcher.close()
+        raise
+
+    _watchers[path] = watcher
+    _pending[path] = pending
+    return pending
+
+
+def has_events(path):
+    """
+    Checks if directories have been created in or moved into ``path`` since
+    it was last polled, without consuming the events. Always False if
+    ``path`` isn't watched by this process.
+    """
+
+    watcher = _watchers.get(path)
+    return watcher is not None and watcher.has_events()
+
+
+def list_pending(path):
+    """
+    Returns the names of the directories in ``path`` that no information
+    package has been created for yet, e.g. since they are still changing
+    """
+
+    pending = _pending.get(path)
+    if pending is not None:
+        return set(pending)
+
+    try:
+        pending = scan(path)
+    except OSError:
+        return set()
+
+    handled = cache.get_many([_get_handled_key(objid) for objid in pending])
+    return {objid for objid in pending if _get_handled_key(objid) not in handled}
+
 
 class DirectoryWorkflowPoller(BaseWorkflowPoller):
-    def poll(self, path, sa=None):
-        for entry in os.listdir(path):
-            subpath = os.path.join(path, entry)
-
-            if os.path.isfile(subpath):
-                continue
-
-            objid = os.path.basename(subpath)
-            if InformationPackage.objects.filter(object_identifier_value=objid).exists():
-                logger.debug(u'Information package with object identifier value "{}" already exists'.format(objid))
-                continue
-
-            if not stable_path(subpath):
-                continue
-
-            sa = SubmissionAgreement.objects.get(name=sa)
-            if sa.profile_workflow is None:
-                logger.debug(u'No workflow profile in SA, skipping')
-                continue
-            if proj not in sa.profile_workflow.specification:
-                logger.debug(
-                    'No workflow specified in {} for current project {}, skipping'.format(
-                        sa.profile_workflow, proj
+    def get_unhandled(self, path, pending):
+        """
+        Returns the directories in ``pending`` that no information package
+        has been created for, the others are removed from ``pending``
+        """
+
+        entries = sorted(pending)
+        handled = cache.get_many([_get_handled_key(objid) for objid in entries])
+        unhandled = []
+
+        candidates = (objid for objid in entries if _get_handled_key(objid) not in handled)
+        for batch in _batches(candidates, QUERY_BATCH_SIZE):
+            existing = set(InformationPackage.objects.filter(
+                object_identifier_value__in=batch,
+            ).values_list('object_identifier_value', flat=True))
+            _set_handled(existing)
+
+            for objid in batch:
+                if objid in existing:
+                    logger.debug(
+                        u'Information package with object identifier value "{}" already exists'.format(objid)
                     )
+                    pending.discard(objid)
+                elif not os.path.isdir(os.path.join(path, objid)):
+                    cache.delete(FINGERPRINT_CACHE_KEY.format(os.path.join(path, objid)))
+                    pending.discard(objid)
+                else:
+                    unhandled.append(objid)
+
+        pending.difference_update(objid for objid in entries if _get_handled_key(objid) in handled)
+        return unhandled
+
+    def get_submission_agreement(self, name):
+        sa = SubmissionAgreement.objects.select_related('profile_workflow').get(name=name)
+        if sa.profile_workflow is None:
+            logger.debug(u'No workflow profile in SA, skipping')
+            return None
+        if proj not in sa.profile_workflow.specification:
+            logger.debug(
+                'No workflow specified in {} for current project {}, skipping'.format(
+                    sa.profile_workflow, proj
                 )
-                continue
+            )
+            return None
 
-            org = Group.objects.get(name='Default')
-            role = 'admin'
-            responsible = GroupMember.objects.filter(roles__codename=role, group=org).get().member.django_user
+        return sa
 
-            ip = InformationPackage.objects.create(
+    @transaction.atomic
+    def create_ips(self, path, objids, sa, org, responsible):
+        ips = InformationPackage.objects.bulk_create([
+            InformationPackage(
                 object_identifier_value=objid,
-                object_path=subpath,
+                object_path=os.path.join(path, objid),
                 package_type=InformationPackage.SIP,
                 submission_agreement=sa,
                 submission_agreement_locked=True,
                 state='Prepared',
                 responsible=responsible,
-            )
+            ) for objid in objids
+        ])
+
+        for ip in ips:
             ip.create_profile_rels(p_types, responsible)
             org.add_object(ip)
-            yield ip
+
+        return ips
+
+    def get_in_flight(self, sa):
+        """
+        Returns the number of information packages of ``sa`` with tasks that
+        are waiting or running, ignoring packages with failed tasks
+        """
+
+        tasks = ProcessTask.objects.filter(information_package__submission_agreement=sa)
+        failed = tasks.filter(status=celery_states.FAILURE).values('information_package')
+        return tasks.filter(
+            status__in=[celery_states.PENDING, celery_states.STARTED],
+        ).exclude(
+            information_package__in=failed,
+        ).values('information_package').distinct().count()
+
+    def get_limit(self, sa, options):
+        """
+        Returns the number of information packages that may be created in
+        this poll, or None if there is no limit
+        """
+
+        limits = []
+        if options.get('batch_size') is not None:
+            limits.append(options['batch_size'])
+
+        if options.get('max_in_flight') is not None:
+            in_flight = self.get_in_flight(sa)
+            if in_flight >= options['max_in_flight']:
+                logger.info(u'{} information packages of {} in flight, waiting'.format(in_flight, sa))
+            limits.append(max(options['max_in_flight'] - in_flight, 0))
+
+        return min(limits) if limits else None
+
+    def poll(self, path, sa=None):
+        pending = get_pending(path)
+        ready = [objid for objid in self.get_unhandled(path, pending) if stable_path(os.path.join(path, objid))]
+        if not ready:
+            return
+
+        options = get_poller_options(path, sa)
+        sa = self.get_submission_agreement(sa)
+        if sa is None:
+            return
+
+        limit = self.get_limit(sa, options)
+        if limit is not None and limit < len(ready):
+            logger.info(u'{} directories in {} are ready, starting {} now'.format(len(ready), path, limit))
+            ready = ready[:limit]
+        if not ready:
+            return
+
+        org = Group.objects.get(name='Default')
+        role = 'admin'
+        responsible = GroupMember.objects.select_related('member__django_user').filter(
+            roles__codename=role, group=org,
+        ).get().member.django_user
+
+        for batch in _batches(ready, QUERY_BATCH_SIZE):
+            for ip in self.create_ips(path, batch, sa, org, responsible):
+                _set_handled([ip.object_identifier_value])
+                cache.delete(FINGERPRINT_CACHE_KEY.format(ip.object_path))
+                pending.discard(ip.object_identifier_value)
+                yield ip
 
     def delete_source(self, path, ip):
         path = os.path.join(path, ip.object_identifier_value)
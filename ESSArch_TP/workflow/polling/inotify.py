@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+WATCH_MASK = IN_CREATE | IN_MOVED_TO | IN_DELETE | IN_MOVED_FROM | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+
+# Events that mean that the watch no longer reflects the directory and it
+# has to be scanned again
+RESCAN_MASK = IN_Q_OVERFLOW | IN_IGNORED | IN_DELETE_SELF | IN_MOVE_SELF
+
+# struct inotify_event, followed by a null padded name of ``len`` bytes
+EVENT_HEADER = struct.Struct('iIII')
+
+READ_SIZE = 64 * 1024
+
+_libc = None
+
+
+def _get_libc():
+    global _libc
+
+    if _libc is None:
+        name = ctypes.util.find_library('c')
+        if name is None:
+            raise OSError(errno.ENOSYS, 'libc not found')
+
+        libc = ctypes.CDLL(name, use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'inotify is not supported on this platform')
+
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        _libc = libc
+
+    return _libc
+
+
+def _check(result, path=None):
+    if result < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err), path)
+    return result
+
+
+class DirectoryWatcher:
+    """
+    Watches a directory for subdirectories being created, moved in, deleted
+    or moved out using inotify(7). Only the directory itself is watched, not
+    its subdirectories.
+
+    Raises:
+        OSError: inotify is not available or the directory can't be watched
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+        libc = _get_libc()
+        self.fd = _check(libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC))
+        try:
+            _check(libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK), path)
+        except OSError:
+            os.close(self.fd)
+            raise
+
+    def _read(self):
+        data = b''
+        while True:
+            try:
+                buf = os.read(self.fd, READ_SIZE)
+            except BlockingIOError:
+                return data
+            if not buf:
+                return data
+            data += buf
+
+    def has_events(self):
+        """
+        Checks, without reading them, if there are events to read
+        """
+
+        readable, _, _ = select.select([self.fd], [], [], 0)
+        return bool(readable)
+
+    def read_events(self):
+        """
+        Reads the events received since the last call without blocking
+
+        Returns:
+            A tuple ``(changed, removed, rescan)`` with the names of the
+            subdirectories created or moved in, the names of those deleted or
+            moved out and whether the directory has to be scanned again
+            since events have been lost
+        """
+
+        changed = set()
+        removed = set()
+        rescan = False
+
+        data = self._read()
+        offset = 0
+        while offset < len(data):
+            _, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+
+            if mask & RESCAN_MASK:
+                rescan = True
+            elif not mask & IN_ISDIR:
+                continue
+            elif mask & (IN_CREATE | IN_MOVED_TO):
+                changed.add(name)
+                removed.discard(name)
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                removed.add(name)
+                changed.discard(name)
+
+        return changed, removed, rescan
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
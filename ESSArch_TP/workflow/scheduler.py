@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import logging
+import os
+import time
+
+from celery import current_app
+from django.conf import settings
+from django.core.cache import cache
+from redis import Redis
+from redis.exceptions import LockError
+
+from workflow.polling.backends import directory
+
+logger = logging.getLogger('essarch.etp.workflow.scheduler')
+
+POLL_STATE_CACHE_KEY = 'etp_workflow_poll_state'
+POLL_TRIGGER_CACHE_KEY = 'etp_workflow_poll_trigger'
+POLL_LOCK_KEY = 'etp_workflow_poll_lock'
+
+RUN_WORKFLOW_PROFILES_TASK = 'ESSArch_Core.tasks.RunWorkflowProfiles'
+POLL_WORKFLOWS_TASK = 'workflow.tasks.PollWorkflows'
+
+_redis = None
+
+
+def get_redis():
+    global _redis
+
+    if _redis is None:
+        _redis = Redis.from_url(settings.REDIS_URL)
+    return _redis
+
+
+def get_intervals():
+    return (
+        getattr(settings, 'WORKFLOW_POLL_MIN_INTERVAL', 10),
+        getattr(settings, 'WORKFLOW_POLL_MAX_INTERVAL', 300),
+    )
+
+
+def get_polled_paths():
+    pollers = getattr(settings, 'ESSARCH_WORKFLOW_POLLERS', {}).values()
+    return [options['path'] for options in pollers if options.get('path')]
+
+
+def get_state():
+    """
+    Returns the current interval between polls, when the last poll finished
+    and the digest of the directories that were pending after it
+    """
+
+    state = cache.get(POLL_STATE_CACHE_KEY)
+    if state is None:
+        state = {'interval': get_intervals()[0], 'last': 0, 'pending': None}
+    return state
+
+
+def get_pending_digest(paths):
+    """
+    Returns a digest of the directories in ``paths`` that no information
+    package has been created for yet, or None if there are none
+    """
+
+    names = []
+    for path in paths:
+        names.extend(os.path.join(path, name) for name in directory.list_pending(path))
+
+    if not names:
+        return None
+    return hashlib.sha1('\n'.join(sorted(names)).encode('utf-8')).hexdigest()
+
+
+def get_next_interval(interval, active):
+    """
+    Returns the minimum interval if there was any activity, or else double
+    ``interval`` up to the maximum interval
+    """
+
+    min_interval, max_interval = get_intervals()
+    if active:
+        return min_interval
+    return min(max(interval, min_interval) * 2, max_interval)
+
+
+def trigger_poll():
+    """
+    Polls as soon as possible, regardless of the current interval. If a poll
+    is already running another one follows it.
+    """
+
+    cache.set(POLL_TRIGGER_CACHE_KEY, True)
+    current_app.send_task(POLL_WORKFLOWS_TASK)
+
+
+def poll():
+    """
+    Runs ``RunWorkflowProfiles`` if polling has been triggered, a polled
+    directory has changed or the current interval has passed since the last
+    poll, and adjusts the interval to whether there was anything to do. The
+    interval is increased after a failed poll as well.
+
+    Only one poll runs at a time, using a lock in Redis.
+
+    Returns:
+        True if ``RunWorkflowProfiles`` was run, else False
+    """
+
+    state = get_state()
+    paths = get_polled_paths()
+
+    triggered = cache.get(POLL_TRIGGER_CACHE_KEY) is not None
+    changed = any(directory.has_events(path) for path in paths)
+    due = time.time() >= state['last'] + state['interval']
+    if not (triggered or changed or due):
+        return False
+
+    lock = get_redis().lock(POLL_LOCK_KEY, timeout=getattr(settings, 'WORKFLOW_POLL_LOCK_TIMEOUT', 3600))
+    if not lock.acquire(blocking=False):
+        logger.debug(u'Workflows are already being polled, skipping')
+        return False
+
+    active = False
+    pending = state.get('pending')
+    try:
+        # a trigger from now on is handled by the next poll
+        cache.delete(POLL_TRIGGER_CACHE_KEY)
+        current_app.tasks[RUN_WORKFLOW_PROFILES_TASK]()
+
+        # pending directories only keep the interval at the minimum while
+        # they come and go, directories that are never handled would
+        # otherwise keep it there forever
+        pending = get_pending_digest(paths)
+        active = triggered or changed or (pending is not None and pending != state.get('pending'))
+    finally:
+        # a failed poll backs off like an idle one
+        interval = get_next_interval(state['interval'], active)
+        cache.set(POLL_STATE_CACHE_KEY, {'interval': interval, 'last': time.time(), 'pending': pending})
+
+        try:
+            lock.release()
+        except LockError:
+            logger.warning(u'Lock on workflow polling expired before the poll finished')
+
+    if interval != state['interval']:
+        logger.debug(u'Polling workflows every {} seconds'.format(interval))
+    return True
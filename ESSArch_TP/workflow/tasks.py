@@ -0,0 +1,10 @@
+# -*- coding: utf-8 -*-
+
+from celery import shared_task
+
+from workflow import scheduler
+
+
+@shared_task(ignore_result=True)
+def PollWorkflows():
+    scheduler.poll()
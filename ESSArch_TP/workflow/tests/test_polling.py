@@ -0,0 +1,291 @@
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+from celery import states as celery_states
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import SimpleTestCase, TestCase, override_settings
+
+from ESSArch_Core.auth.models import Group, GroupMember, GroupMemberRole, GroupType
+from ESSArch_Core.ip.models import InformationPackage
+from ESSArch_Core.profiles.models import Profile, SubmissionAgreement
+from ESSArch_Core.WorkflowEngine.models import ProcessTask
+
+from workflow.polling.backends import directory
+from workflow.polling.backends.directory import DirectoryWorkflowPoller
+from workflow.polling.inotify import DirectoryWatcher
+
+
+class DirectoryWatcherTests(SimpleTestCase):
+    def setUp(self):
+        self.datadir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.datadir)
+
+        try:
+            self.watcher = DirectoryWatcher(self.datadir)
+        except OSError:
+            self.skipTest('inotify not available')
+        self.addCleanup(self.watcher.close)
+
+    def test_no_events(self):
+        self.assertEqual(self.watcher.read_events(), (set(), set(), False))
+
+    def test_created_directories(self):
+        os.mkdir(os.path.join(self.datadir, 'foo'))
+        os.mkdir(os.path.join(self.datadir, 'bar'))
+        os.mkdir(os.path.join(self.datadir, 'bar', 'baz'))
+        open(os.path.join(self.datadir, 'file.txt'), 'w').close()
+
+        self.assertEqual(self.watcher.read_events(), ({'foo', 'bar'}, set(), False))
+
+    def test_moved_directories(self):
+        src = tempfile.mkdtemp()
+        os.rename(src, os.path.join(self.datadir, 'foo'))
+        os.rename(os.path.join(self.datadir, 'foo'), src)
+        self.addCleanup(shutil.rmtree, src)
+
+        self.assertEqual(self.watcher.read_events(), (set(), {'foo'}, False))
+
+    def test_removed_directory(self):
+        os.mkdir(os.path.join(self.datadir, 'foo'))
+        self.watcher.read_events()
+        os.rmdir(os.path.join(self.datadir, 'foo'))
+
+        self.assertEqual(self.watcher.read_events(), (set(), {'foo'}, False))
+
+    def test_has_events(self):
+        self.assertFalse(self.watcher.has_events())
+        os.mkdir(os.path.join(self.datadir, 'foo'))
+
+        self.assertTrue(self.watcher.has_events())
+        self.assertTrue(self.watcher.has_events())
+        self.assertEqual(self.watcher.read_events(), ({'foo'}, set(), False))
+        self.assertFalse(self.watcher.has_events())
+
+    def test_watched_directory_removed(self):
+        shutil.rmtree(self.datadir)
+        os.mkdir(self.datadir)
+
+        self.assertTrue(self.watcher.read_events()[2])
+
+
+class GetPendingTests(SimpleTestCase):
+    def setUp(self):
+        self.datadir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.datadir)
+        self.addCleanup(directory._close_watcher, self.datadir)
+
+        os.mkdir(os.path.join(self.datadir, 'foo'))
+        open(os.path.join(self.datadir, 'file.txt'), 'w').close()
+
+    @override_settings(WORKFLOW_POLLER_INOTIFY=False)
+    def test_scan(self):
+        self.assertEqual(directory.get_pending(self.datadir), {'foo'})
+        os.mkdir(os.path.join(self.datadir, 'bar'))
+        self.assertEqual(directory.get_pending(self.datadir), {'foo', 'bar'})
+        self.assertNotIn(self.datadir, directory._watchers)
+
+    @mock.patch('workflow.polling.backends.directory.DirectoryWatcher', side_effect=OSError)
+    def test_scan_without_inotify(self, mock_watcher):
+        self.assertEqual(directory.get_pending(self.datadir), {'foo'})
+        self.assertNotIn(self.datadir, directory._watchers)
+
+    def test_inotify(self):
+        pending = directory.get_pending(self.datadir)
+        if self.datadir not in directory._watchers:
+            self.skipTest('inotify not available')
+        self.assertEqual(pending, {'foo'})
+
+        with mock.patch('workflow.polling.backends.directory.scan') as mock_scan:
+            os.mkdir(os.path.join(self.datadir, 'bar'))
+            self.assertEqual(directory.get_pending(self.datadir), {'foo', 'bar'})
+
+            pending.discard('foo')
+            os.rmdir(os.path.join(self.datadir, 'bar'))
+            self.assertEqual(directory.get_pending(self.datadir), set())
+
+            mock_scan.assert_not_called()
+
+    def test_inotify_rescan_after_lost_events(self):
+        directory.get_pending(self.datadir)
+        watcher = directory._watchers.get(self.datadir)
+        if watcher is None:
+            self.skipTest('inotify not available')
+
+        with mock.patch.object(watcher, 'read_events', return_value=(set(), set(), True)):
+            self.assertEqual(directory.get_pending(self.datadir), {'foo'})
+
+        self.assertIsNot(directory._watchers[self.datadir], watcher)
+
+    @override_settings(WORKFLOW_POLLER_INOTIFY=False)
+    def test_list_pending_without_watcher(self):
+        self.addCleanup(cache.delete, directory._get_handled_key('foo'))
+        self.assertEqual(directory.list_pending(self.datadir), {'foo'})
+
+        cache.set(directory._get_handled_key('foo'), True)
+        self.assertEqual(directory.list_pending(self.datadir), set())
+
+    def test_list_pending_with_watcher(self):
+        pending = directory.get_pending(self.datadir)
+        if self.datadir not in directory._watchers:
+            self.skipTest('inotify not available')
+
+        self.assertEqual(directory.list_pending(self.datadir), {'foo'})
+        self.assertFalse(directory.has_events(self.datadir))
+
+        pending.clear()
+        self.assertEqual(directory.list_pending(self.datadir), set())
+
+
+class StablePathTests(SimpleTestCase):
+    def setUp(self):
+        self.datadir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.datadir)
+        self.addCleanup(cache.delete, directory.FINGERPRINT_CACHE_KEY.format(self.datadir))
+
+        os.makedirs(os.path.join(self.datadir, 'a', 'b'))
+        self.write('foo.txt', b'foo')
+        self.write(os.path.join('a', 'b', 'bar.txt'), b'bar!')
+
+    def write(self, name, content):
+        with open(os.path.join(self.datadir, name), 'wb') as f:
+            f.write(content)
+
+    def test_fingerprint(self):
+        count, size, _ = directory.get_fingerprint(self.datadir)
+        self.assertEqual((count, size), (2, 7))
+
+    def test_fingerprint_changes_with_nested_file(self):
+        before = directory.get_fingerprint(self.datadir)
+        path = os.path.join(self.datadir, 'a', 'b', 'bar.txt')
+        os.utime(path, ns=(0, before[2] + 1000000000))
+        self.assertNotEqual(directory.get_fingerprint(self.datadir), before)
+
+    def test_stable_once_unchanged(self):
+        self.assertFalse(directory.stable_path(self.datadir))
+        self.assertTrue(directory.stable_path(self.datadir))
+
+        self.write('baz.txt', b'baz')
+        self.assertFalse(directory.stable_path(self.datadir))
+        self.assertTrue(directory.stable_path(self.datadir))
+
+    @override_settings(WORKFLOW_POLLER_STABLE_POLLS=3)
+    def test_stable_polls(self):
+        results = [directory.stable_path(self.datadir) for _ in range(4)]
+        self.assertEqual(results, [False, False, False, True])
+
+
+@override_settings(WORKFLOW_POLLER_INOTIFY=False)
+@mock.patch('workflow.polling.backends.directory.stable_path', return_value=True)
+class DirectoryWorkflowPollerTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.datadir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.datadir)
+
+        self.user = User.objects.create(username='admin')
+        group_type = GroupType.objects.create(label='organization')
+        self.org = Group.objects.create(name='Default', group_type=group_type)
+        membership = GroupMember.objects.create(member=self.user.essauth_member, group=self.org)
+        membership.roles.add(GroupMemberRole.objects.create(codename='admin'))
+
+        workflow = Profile.objects.create(profile_type='workflow', name='workflow', specification={'ETP': []})
+        self.sa = SubmissionAgreement.objects.create(name='sa', profile_workflow=workflow)
+
+        self.poller = DirectoryWorkflowPoller()
+
+    def poll(self):
+        return list(self.poller.poll(self.datadir, 'sa'))
+
+    def poller_settings(self, **options):
+        options.update({'path': self.datadir, 'sa': 'sa'})
+        return self.settings(ESSARCH_WORKFLOW_POLLERS={'dir': options})
+
+    def test_create_ips(self, mock_stable):
+        for objid in ['foo', 'bar']:
+            os.mkdir(os.path.join(self.datadir, objid))
+        open(os.path.join(self.datadir, 'file.txt'), 'w').close()
+
+        ips = self.poll()
+
+        self.assertCountEqual([ip.object_identifier_value for ip in ips], ['foo', 'bar'])
+        for ip in InformationPackage.objects.all():
+            self.assertEqual(ip.object_path, os.path.join(self.datadir, ip.object_identifier_value))
+            self.assertEqual(ip.submission_agreement, self.sa)
+            self.assertEqual(ip.responsible, self.user)
+            self.assertEqual(ip.state, 'Prepared')
+
+        self.assertEqual(self.poll(), [])
+        self.assertEqual(InformationPackage.objects.count(), 2)
+
+    def test_unstable_directory(self, mock_stable):
+        os.mkdir(os.path.join(self.datadir, 'foo'))
+        mock_stable.return_value = False
+
+        self.assertEqual(self.poll(), [])
+        self.assertFalse(InformationPackage.objects.exists())
+
+    def test_no_workflow_in_sa(self, mock_stable):
+        self.sa.profile_workflow = None
+        self.sa.save()
+        os.mkdir(os.path.join(self.datadir, 'foo'))
+
+        self.assertEqual(self.poll(), [])
+        self.assertFalse(InformationPackage.objects.exists())
+
+    def test_existing_ips_checked_in_batches(self, mock_stable):
+        for i in range(directory.QUERY_BATCH_SIZE + 10):
+            objid = 'ip{}'.format(i)
+            os.mkdir(os.path.join(self.datadir, objid))
+            InformationPackage.objects.create(object_identifier_value=objid)
+
+        with self.assertNumQueries(2):
+            self.assertEqual(self.poll(), [])
+
+        # handled directories are cached
+        with self.assertNumQueries(0):
+            self.assertEqual(self.poll(), [])
+
+    @override_settings(WORKFLOW_POLLER_HANDLED_TIMEOUT=60)
+    def test_handled_directories_expire(self, mock_stable):
+        os.mkdir(os.path.join(self.datadir, 'foo'))
+
+        with mock.patch.object(cache, 'set_many', wraps=cache.set_many) as mock_set:
+            self.assertEqual(len(self.poll()), 1)
+        mock_set.assert_called_once_with({directory._get_handled_key('foo'): True}, timeout=60)
+
+        # the directory is delivered again after its IP has been deleted
+        InformationPackage.objects.all().delete()
+        cache.delete(directory._get_handled_key('foo'))
+        self.assertEqual(len(self.poll()), 1)
+
+    def test_batch_size(self, mock_stable):
+        for objid in ['foo', 'bar', 'baz']:
+            os.mkdir(os.path.join(self.datadir, objid))
+
+        with self.poller_settings(batch_size=2):
+            self.assertEqual(len(self.poll()), 2)
+            self.assertEqual(len(self.poll()), 1)
+
+    def test_back_pressure(self, mock_stable):
+        ip = InformationPackage.objects.create(object_identifier_value='in flight', submission_agreement=self.sa)
+        task = ProcessTask.objects.create(name='foo', information_package=ip, status=celery_states.STARTED)
+        os.mkdir(os.path.join(self.datadir, 'foo'))
+
+        with self.poller_settings(max_in_flight=1):
+            self.assertEqual(self.poll(), [])
+
+            task.status = celery_states.SUCCESS
+            task.save()
+            self.assertEqual(len(self.poll()), 1)
+
+    def test_failed_ips_are_not_in_flight(self, mock_stable):
+        ip = InformationPackage.objects.create(object_identifier_value='failed', submission_agreement=self.sa)
+        ProcessTask.objects.create(name='foo', information_package=ip, status=celery_states.FAILURE)
+        ProcessTask.objects.create(name='bar', information_package=ip, status=celery_states.PENDING)
+        os.mkdir(os.path.join(self.datadir, 'foo'))
+
+        with self.poller_settings(max_in_flight=1):
+            self.assertEqual(len(self.poll()), 1)
@@ -0,0 +1,135 @@
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+from django.core.cache import cache
+from django.test import SimpleTestCase, override_settings
+from redis.exceptions import LockError
+
+from workflow import scheduler
+
+
+@override_settings(WORKFLOW_POLL_MIN_INTERVAL=10, WORKFLOW_POLL_MAX_INTERVAL=300)
+class GetNextIntervalTests(SimpleTestCase):
+    def test_backoff_when_idle(self):
+        intervals = [10]
+        for _ in range(6):
+            intervals.append(scheduler.get_next_interval(intervals[-1], active=False))
+        self.assertEqual(intervals, [10, 20, 40, 80, 160, 300, 300])
+
+    def test_reset_on_activity(self):
+        self.assertEqual(scheduler.get_next_interval(300, active=True), 10)
+
+
+@override_settings(WORKFLOW_POLL_MIN_INTERVAL=10, WORKFLOW_POLL_MAX_INTERVAL=300, WORKFLOW_POLLER_INOTIFY=False)
+class PollTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+        self.datadir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.datadir)
+
+        pollers = {'dir': {'path': self.datadir, 'sa': 'sa'}}
+        settings_patcher = self.settings(ESSARCH_WORKFLOW_POLLERS=pollers)
+        settings_patcher.enable()
+        self.addCleanup(settings_patcher.disable)
+
+        self.lock = mock.Mock()
+        self.lock.acquire.return_value = True
+        redis_patcher = mock.patch('workflow.scheduler.get_redis')
+        redis_patcher.start().return_value.lock.return_value = self.lock
+        self.addCleanup(redis_patcher.stop)
+
+        app_patcher = mock.patch('workflow.scheduler.current_app')
+        self.app = app_patcher.start()
+        self.addCleanup(app_patcher.stop)
+        self.run_workflow_profiles = self.app.tasks.__getitem__.return_value
+
+        time_patcher = mock.patch('workflow.scheduler.time.time', return_value=1000)
+        self.time = time_patcher.start()
+        self.addCleanup(time_patcher.stop)
+
+    def test_first_poll(self):
+        self.assertTrue(scheduler.poll())
+        self.app.tasks.__getitem__.assert_called_once_with(scheduler.RUN_WORKFLOW_PROFILES_TASK)
+        self.run_workflow_profiles.assert_called_once_with()
+        self.lock.release.assert_called_once_with()
+
+    def test_backoff_when_idle(self):
+        scheduler.poll()
+        self.assertEqual(scheduler.get_state(), {'interval': 20, 'last': 1000, 'pending': None})
+
+        self.time.return_value = 1019
+        self.assertFalse(scheduler.poll())
+
+        self.time.return_value = 1020
+        self.assertTrue(scheduler.poll())
+        self.assertEqual(scheduler.get_state(), {'interval': 40, 'last': 1020, 'pending': None})
+        self.assertEqual(self.run_workflow_profiles.call_count, 2)
+
+    def test_new_pending_directories_keep_min_interval(self):
+        os.mkdir(os.path.join(self.datadir, 'foo'))
+
+        scheduler.poll()
+        self.assertEqual(scheduler.get_state()['interval'], 10)
+
+        self.time.return_value = 1010
+        os.mkdir(os.path.join(self.datadir, 'bar'))
+        scheduler.poll()
+        self.assertEqual(scheduler.get_state()['interval'], 10)
+
+    def test_unhandled_pending_directories_back_off(self):
+        os.mkdir(os.path.join(self.datadir, 'foo'))
+        scheduler.poll()
+
+        self.time.return_value = 1010
+        scheduler.poll()
+        self.assertEqual(scheduler.get_state()['interval'], 20)
+
+    def test_trigger(self):
+        cache.set(scheduler.POLL_STATE_CACHE_KEY, {'interval': 300, 'last': 1000})
+        self.assertFalse(scheduler.poll())
+
+        scheduler.trigger_poll()
+        self.app.send_task.assert_called_once_with(scheduler.POLL_WORKFLOWS_TASK)
+
+        self.assertTrue(scheduler.poll())
+        self.assertEqual(scheduler.get_state()['interval'], 10)
+        self.assertIsNone(cache.get(scheduler.POLL_TRIGGER_CACHE_KEY))
+
+    @mock.patch('workflow.scheduler.directory.has_events', return_value=True)
+    def test_directory_changed(self, mock_has_events):
+        cache.set(scheduler.POLL_STATE_CACHE_KEY, {'interval': 300, 'last': 1000})
+
+        self.assertTrue(scheduler.poll())
+        mock_has_events.assert_called_once_with(self.datadir)
+        self.assertEqual(scheduler.get_state()['interval'], 10)
+
+    def test_already_running(self):
+        self.lock.acquire.return_value = False
+
+        self.assertFalse(scheduler.poll())
+        self.run_workflow_profiles.assert_not_called()
+        self.lock.acquire.assert_called_once_with(blocking=False)
+
+    def test_lock_released_on_failure(self):
+        self.run_workflow_profiles.side_effect = ValueError
+
+        with self.assertRaises(ValueError):
+            scheduler.poll()
+        self.lock.release.assert_called_once_with()
+
+    def test_backoff_on_failure(self):
+        self.run_workflow_profiles.side_effect = ValueError
+        scheduler.trigger_poll()
+
+        with self.assertRaises(ValueError):
+            scheduler.poll()
+        self.assertEqual(scheduler.get_state(), {'interval': 20, 'last': 1000, 'pending': None})
+
+    def test_expired_lock(self):
+        self.lock.release.side_effect = LockError
+
+        self.assertTrue(scheduler.poll())
@@ -0,0 +1,60 @@
+from django.test import TestCase
+
+from ESSArch_Core.ip.models import InformationPackage
+from ESSArch_Core.WorkflowEngine.models import ProcessStep
+
+from workflow.util import create_workflow
+
+
+class CreateWorkflowTests(TestCase):
+    def setUp(self):
+        self.ip = InformationPackage.objects.create()
+
+    def task(self, label):
+        return {"name": "ESSArch_Core.tasks.UpdateIPStatus", "label": label, "args": [label]}
+
+    def test_parallel_steps(self):
+        spec = [
+            self.task('first'),
+            {
+                "step": True,
+                "name": "Parallel",
+                "parallel": True,
+                "children": [
+                    self.task('a'),
+                    {
+                        "step": True,
+                        "name": "Sequential",
+                        "children": [self.task('b'), self.task('c')],
+                    },
+                ],
+            },
+            {
+                "step": True,
+                "name": "Skipped",
+                "if": False,
+                "parallel": True,
+                "children": [self.task('d')],
+            },
+            {
+                "step": True,
+                "name": "Nested",
+                "children": [
+                    {
+                        "step": True,
+                        "name": "Inner",
+                        "parallel": True,
+                        "children": [self.task('e'), self.task('f')],
+                    },
+                ],
+            },
+        ]
+
+        workflow = create_workflow(spec, self.ip)
+
+        self.assertFalse(workflow.parallel)
+        self.assertTrue(ProcessStep.objects.get(name='Parallel').parallel)
+        self.assertFalse(ProcessStep.objects.get(name='Sequential').parallel)
+        self.assertFalse(ProcessStep.objects.get(name='Nested').parallel)
+        self.assertTrue(ProcessStep.objects.get(name='Inner').parallel)
+        self.assertFalse(ProcessStep.objects.filter(name='Skipped').exists())
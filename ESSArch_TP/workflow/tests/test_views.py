@@ -0,0 +1,28 @@
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.test import SimpleTestCase
+from rest_framework import status
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from workflow.views import WorkflowPollView
+
+
+@mock.patch('workflow.views.trigger_poll')
+class WorkflowPollViewTests(SimpleTestCase):
+    def post(self, user):
+        request = APIRequestFactory().post('/api/workflow-poll/')
+        force_authenticate(request, user=user)
+        return WorkflowPollView.as_view()(request)
+
+    def test_admin(self, mock_trigger):
+        res = self.post(User(username='admin', is_staff=True))
+
+        self.assertEqual(res.status_code, status.HTTP_202_ACCEPTED)
+        mock_trigger.assert_called_once_with()
+
+    def test_not_admin(self, mock_trigger):
+        res = self.post(User(username='user'))
+
+        self.assertEqual(res.status_code, status.HTTP_403_FORBIDDEN)
+        mock_trigger.assert_not_called()
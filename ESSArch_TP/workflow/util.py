@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+
+from ESSArch_Core.WorkflowEngine.models import ProcessStep
+from ESSArch_Core.WorkflowEngine.util import create_workflow as core_create_workflow
+
+
+def _is_created_step(entry):
+    return entry.get('step', False) and entry.get('if', True)
+
+
+def mark_parallel_steps(step, workflow_spec):
+    """
+    Sets ``parallel`` on the steps created from entries in ``workflow_spec``
+    that are marked with ``"parallel": True``. The children of a parallel
+    step are run concurrently as a Celery group and the step finishes when
+    all of them have finished.
+    """
+
+    children = {}
+    for child in step.child_steps.all():
+        children.setdefault(child.name, []).append(child)
+
+    for entry in filter(_is_created_step, workflow_spec):
+        try:
+            child = children[entry['name']].pop(0)
+        except (KeyError, IndexError):
+            continue
+
+        if entry.get('parallel', False):
+            ProcessStep.objects.filter(pk=child.pk).update(parallel=True)
+
+        mark_parallel_steps(child, entry.get('children', []))
+
+
+def create_workflow(workflow_spec, *args, **kwargs):
+    """
+    Creates a workflow using ``create_workflow`` in ESSArch Core, with
+    support for running the children of steps marked with
+    ``"parallel": True`` concurrently, e.g.
+
+        {
+            "step": True,
+            "name": "Validation",
+            "parallel": True,
+            "children": [...],
+        }
+
+    Only steps whose children don't depend on each other may be parallel.
+    """
+
+    workflow = core_create_workflow(workflow_spec, *args, **kwargs)
+    mark_parallel_steps(workflow, workflow_spec)
+    workflow.refresh_from_db()
+    return workflow
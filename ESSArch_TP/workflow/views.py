@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+
+from rest_framework import permissions, status
+from rest_framework.response import Response
+from rest_framework.views import APIView
+
+from workflow.scheduler import trigger_poll
+
+
+class WorkflowPollView(APIView):
+    """
+    Polls for new information packages now instead of when the current
+    interval has passed, e.g. when a producer has finished delivering.
+    Restricted to administrators since every poll scans the polled
+    directories and resets the interval.
+    """
+
+    permission_classes = (permissions.IsAdminUser,)
+
+    def post(self, request):
+        trigger_poll()
+        return Response({'detail': 'Polling workflows'}, status=status.HTTP_202_ACCEPTED)